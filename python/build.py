@@ -0,0 +1,377 @@
+import argparse
+import hashlib
+import imp
+import inspect
+import json
+import os
+import time
+from multiprocessing import Process, cpu_count
+
+import event_index
+import feature_factory
+import feature_impl
+import ingest
+import vocab
+
+path_state = '../data/build_state.json'
+
+# concat name -> features, in column order
+concats = {
+    'ensemble_100': ['phone_brand', 'device_model', 'installed_app', 'installed_app_label', 'device_long_lat_norm',
+                     'active_app_freq', 'active_app_label_freq', 'active_app_label_category',
+                     'active_app_label_cluster_40', 'active_app_label_diff_hour_category_freq',
+                     'device_day_event_num_freq', 'device_hour_event_num_freq', 'device_weekday_event_num_freq',
+                     'concat_23_freq_net2net_mlp_39', 'concat_24_freq_net2net_mlp_1024',
+                     'concat_25_diff_net2net_mlp_1'],
+}
+
+label_clusters = [40, 100, 270]
+
+
+def code(module, funcs):
+    return [(module, f) for f in funcs]
+
+
+# helpers the stage functions call, fingerprinted along with them; stages reading the ingest cache have its
+# manifests as inputs, so they only list the reading side of ingest
+ingest_code = code('ingest', ['find_source', 'open_source', 'source_stat', 'iter_source', 'read_blocks', 'parse_block',
+                              'parse_blocks', 'write_npy_header', 'get_table_dir', 'get_manifest_path'])
+table_code = code('ingest', ['load_table', 'iter_blocks', 'unique_column'])
+vocabulary_code = code('stat', ['load_vocabulary', 'dump_vocabulary']) + \
+    code('vocab', ['Vocabulary.add', 'Vocabulary.add_all', 'Vocabulary.load', 'Vocabulary.dump', 'Vocabulary.to_dict',
+                   'Vocabulary.to_id_map', 'IdMap.build', 'IdMap.dump'])
+id_map_code = code('vocab', ['load_id_map', 'IdMap.load', 'IdMap.lookup', 'IdMap.encode'])
+watermark_code = [('stat', 'get_watermark'), ('ingest', 'read_manifest'), ('event_index', 'dump_watermark')]
+device_index_code = code('event_index', ['timestamp_2_epoch', 'decode_time', 'DeviceEventIndex.build',
+                                         'DeviceEventIndex.dump']) + watermark_code
+app_index_code = code('event_index', ['AppEventIndex.build', 'AppEventIndex.dump', 'dump_csr']) + watermark_code
+
+
+def feature_stage_code(name):
+    # the proc with its kernels, and the Feature methods writing its output
+    cls = feature_factory.find_feature(name).__class__.__name__
+    return code('feature_factory', ['find_feature', 'get_proc_args']) + \
+        code('feature', ['Feature.process', 'Feature.dump', cls + '.process', cls + '.dump', 'process_sharded',
+                         'concat_shards']) + feature_impl.get_proc_code(name)
+
+
+loaded_modules = {}
+
+
+def load_module(name):
+    # stat.py shadows the stdlib module of the same name, so stage modules are loaded from their files
+    if name not in loaded_modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(ingest.__file__)), name + '.py')
+        loaded_modules[name] = imp.load_source('build_' + name, path)
+    return loaded_modules[name]
+
+
+class Stage:
+    def __init__(self, name, module, func, args=(), inputs=(), outputs=(), code=None):
+        self.__name = name
+        self.__module = module
+        self.__func = func
+        self.__args = tuple(args)
+        self.__inputs = list(inputs)
+        self.__outputs = list(outputs)
+        # functions whose source is part of the fingerprint, editing them invalidates the stage,
+        # dotted names are methods
+        if code is None:
+            code = [(module, func)]
+        self.__code = code
+
+    def get_name(self):
+        return self.__name
+
+    def get_module(self):
+        return self.__module
+
+    def get_func(self):
+        return self.__func
+
+    def get_args(self):
+        return self.__args
+
+    def get_inputs(self):
+        return self.__inputs
+
+    def get_outputs(self):
+        return self.__outputs
+
+    def get_code(self):
+        return self.__code
+
+
+def file_fingerprint(path, mode='mtime'):
+    if not os.path.exists(path):
+        return None
+    if mode == 'mtime':
+        st = os.stat(path)
+        return '%d:%d' % (st.st_size, int(st.st_mtime * 1000))
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def stage_fingerprint(stage, mode='mtime'):
+    md5 = hashlib.md5()
+    for module, func in stage.get_code():
+        md5.update(inspect.getsource(reduce(getattr, func.split('.'), load_module(module))))
+    md5.update(repr(stage.get_args()))
+    for path in stage.get_inputs():
+        md5.update('%s=%s\n' % (path, file_fingerprint(path, mode)))
+    return md5.hexdigest()
+
+
+def run_stage(module, func, args):
+    getattr(load_module(module), func)(*args)
+
+
+class Builder:
+    def __init__(self, mode='mtime', num_worker=None, path=path_state):
+        self.__mode = mode
+        self.__num_worker = num_worker
+        self.__path = path
+        self.__stages = {}
+        self.__producers = {}
+        self.__state = {}
+
+    def get_stage(self, name):
+        return self.__stages[name]
+
+    def get_stage_names(self):
+        return sorted(self.__stages.keys())
+
+    def add_stage(self, stage):
+        self.__stages[stage.get_name()] = stage
+        for path in stage.get_outputs():
+            self.__producers[path] = stage.get_name()
+
+    def get_producer(self, path):
+        return self.__producers.get(path)
+
+    def get_dependencies(self, name):
+        # inputs no stage produces are source files
+        return set([self.__producers[p] for p in self.__stages[name].get_inputs() if p in self.__producers])
+
+    def plan(self, targets):
+        needed = set()
+        queue = list(targets)
+        while len(queue) > 0:
+            name = queue.pop()
+            if name not in needed:
+                needed.add(name)
+                queue.extend(self.get_dependencies(name))
+        return needed
+
+    def load_state(self):
+        if os.path.exists(self.__path):
+            with open(self.__path, 'r') as fin:
+                self.__state = json.load(fin)
+
+    def dump_state(self):
+        with open(self.__path + '.tmp', 'w') as fout:
+            json.dump(self.__state, fout, indent=2, sort_keys=True)
+        os.rename(self.__path + '.tmp', self.__path)
+
+    def is_fresh(self, name, fingerprint):
+        for path in self.__stages[name].get_outputs():
+            if not os.path.exists(path):
+                return False
+        return self.__state.get(name) == fingerprint
+
+    def build(self, targets=None):
+        if targets is None:
+            targets = self.get_stage_names()
+        pending = self.plan(targets)
+        self.load_state()
+        print 'build', len(pending), 'stages'
+        start_time = time.time()
+
+        num_worker = self.__num_worker or cpu_count()
+        done = set()
+        running = {}
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for name in sorted(pending):
+                    if len(running) >= num_worker:
+                        break
+                    if not self.get_dependencies(name) <= done:
+                        continue
+                    pending.remove(name)
+                    # fingerprint is taken once the dependencies are done, so it sees their fresh outputs
+                    fingerprint = stage_fingerprint(self.__stages[name], self.__mode)
+                    if self.is_fresh(name, fingerprint):
+                        print 'skip', name
+                        done.add(name)
+                        continue
+                    print 'run', name
+                    stage = self.__stages[name]
+                    # each stage gets its own non-daemonic process, so stages can start pools of their own
+                    proc = Process(target=run_stage, args=(stage.get_module(), stage.get_func(), stage.get_args()))
+                    proc.start()
+                    running[name] = (proc, fingerprint, time.time())
+
+                for name in sorted(running.keys()):
+                    proc, fingerprint, stage_time = running[name]
+                    if not proc.is_alive():
+                        proc.join()
+                        del running[name]
+                        if proc.exitcode != 0:
+                            raise RuntimeError('stage %s failed with exit code %d' % (name, proc.exitcode))
+                        print 'finish', name, 'in %d sec' % (time.time() - stage_time)
+                        self.__state[name] = fingerprint
+                        self.dump_state()
+                        done.add(name)
+                time.sleep(0.1)
+        except:
+            for proc, _, _ in running.values():
+                proc.terminate()
+            raise
+        print 'build finish in %d sec' % (time.time() - start_time)
+
+
+def default_builder(mode='mtime', num_worker=None, fused=False):
+    # fused builds all base features in one stage, sharing their intermediates
+    builder = Builder(mode, num_worker)
+
+    manifest = {}
+    for table, (source, _) in ingest.tables.iteritems():
+        manifest[table] = ingest.get_manifest_path(table)
+        builder.add_stage(Stage('ingest_' + table, 'ingest', 'ingest_table', [table], [ingest.find_source(source)],
+                                [manifest[table]], [('ingest', 'ingest_table')] + ingest_code))
+
+    data_label_categories = feature_factory.data_label_categories
+    data_phone = feature_factory.data_phone_brand_device_model
+    map_device = vocab.IdMap('device').get_files()
+    map_app = vocab.IdMap('app').get_files()
+    map_label = vocab.IdMap('label').get_files()
+    device_event_files = event_index.DeviceEventIndex().get_files()
+    app_event_files = event_index.AppEventIndex().get_files()
+
+    builder.add_stage(Stage('make_label_id', 'stat', 'make_label_id', [],
+                            [manifest['app_labels'], data_label_categories],
+                            ['../data/dict_id_label.pkl', '../data/id_label.csv'] + map_label,
+                            [('stat', 'make_label_id')] + table_code + vocabulary_code))
+    builder.add_stage(Stage('make_app_id', 'stat', 'make_app_id', [],
+                            [manifest['app_labels'], manifest['app_events']],
+                            ['../data/dict_id_app.pkl', '../data/id_app.csv'] + map_app,
+                            [('stat', 'make_app_id')] + table_code + vocabulary_code))
+    builder.add_stage(Stage('make_device_id', 'stat', 'make_device_id', [],
+                            [manifest['phone_brand_device_model'], manifest['events'], manifest['gender_age_train'],
+                             manifest['gender_age_test']],
+                            ['../data/dict_id_device.pkl', '../data/id_device.csv'] + map_device,
+                            [('stat', 'make_device_id')] + table_code + vocabulary_code))
+    builder.add_stage(Stage('make_brand_model_id', 'stat', 'make_brand_model_id', [], [data_phone],
+                            ['../data/dict_id_brand.pkl', '../data/dict_id_model.pkl'],
+                            [('stat', 'make_brand_model_id')] + vocabulary_code))
+    builder.add_stage(Stage('build_index_brand_model', 'stat', 'build_index_brand_model', [],
+                            [data_phone, '../data/dict_id_brand.pkl', '../data/dict_id_model.pkl'] + map_device,
+                            ['../data/dict_device_brand_model.pkl', '../data/dict_brand_device.pkl',
+                             '../data/dict_model_device.pkl'],
+                            [('stat', 'build_index_brand_model')] + id_map_code))
+    builder.add_stage(Stage('aggregate_app_label', 'stat', 'aggregate_app_label', [],
+                            [manifest['app_labels']] + map_app + map_label, ['../data/dict_app_label.pkl'],
+                            [('stat', 'aggregate_app_label')] + table_code + id_map_code))
+    builder.add_stage(Stage('aggregate_label_category', 'stat', 'aggregate_label_category', [],
+                            [data_label_categories] + map_label, ['../data/label_category_group_number.npy'],
+                            code('stat', ['aggregate_label_category', 'classify_categories', 'change_category_2_group',
+                                          'change_group_name_2_number']) + id_map_code))
+    builder.add_stage(Stage('aggregate_device_event', 'stat', 'aggregate_device_event', [],
+                            [manifest['events']] + map_device, device_event_files,
+                            [('stat', 'aggregate_device_event')] + table_code + id_map_code + device_index_code))
+    builder.add_stage(Stage('build_event_dict', 'stat', 'build_event_dict', [],
+                            [manifest['events']] + map_device, ['../data/dict_event.pkl'],
+                            code('stat', ['build_event_dict', 'update_event_dict']) + table_code + id_map_code +
+                            watermark_code))
+    builder.add_stage(Stage('aggregate_app_event', 'stat', 'aggregate_app_event', [],
+                            [manifest['app_events']] + map_app, app_event_files,
+                            [('stat', 'aggregate_app_event')] + table_code + id_map_code + app_index_code))
+    builder.add_stage(Stage('count_label_coocur', 'stat', 'count_label_coocur', [],
+                            app_event_files + map_label + ['../data/dict_app_label.pkl'],
+                            ['../data/label_coocur.pkl', '../data/label_coocur_tfidf.pkl'],
+                            code('stat', ['count_label_coocur', 'count_coocur', 'count_coocur_chunk']) + id_map_code +
+                            code('event_index', ['AppEventIndex.load', 'load_csr']) + [('utils', 'dict_2_csr'),
+                                                                                        ('tf_idf', 'tf_idf')]))
+    builder.add_stage(Stage('label_cluster', 'stat', 'coocur_cluster',
+                            ['../data/label_coocur_tfidf.pkl', label_clusters], ['../data/label_coocur_tfidf.pkl'],
+                            ['../data/dict_label_cluster_%d.pkl' % k for k in label_clusters],
+                            code('stat', ['coocur_cluster', 'single_linkage', 'cut_merge_tree', 'find_parent',
+                                          'join_parent'])))
+
+    builder.add_stage(Stage('gather_device_id', 'feature_factory', 'gather_device_id', [],
+                            [feature_factory.data_gender_age_train, feature_factory.data_gender_age_test] + map_device,
+                            ['../feature/device_id'],
+                            code('feature_factory', ['gather_device_id', 'read_data', 'encode_device_id']) +
+                            id_map_code))
+    builder.add_stage(Stage('gather_event_id', 'feature_factory', 'gather_event_id', [],
+                            ['../feature/device_id'] + device_event_files, feature_factory.get_event_files(),
+                            code('feature_factory', ['gather_event_id', 'get_subset_size']) +
+                            code('event_index', ['DeviceEventIndex.load', 'DeviceEventIndex.get_rows'])))
+
+    fea_names = []
+    for name in dir(feature_impl):
+        if not name.endswith('_proc'):
+            continue
+        name = name[:-len('_proc')]
+        try:
+            feature_factory.find_feature(name)
+            inputs = feature_factory.get_feature_inputs(name)
+        except KeyError:
+            # no feature object, or a proc deriving from another feature's values
+            continue
+        fea_names.append(name)
+        if not fused:
+            builder.add_stage(Stage('feature_' + name, 'feature_factory', 'build_feature', [name], inputs,
+                                    ['../feature/' + name],
+                                    [('feature_factory', 'build_feature')] + feature_stage_code(name)))
+    if fused:
+        inputs = sorted(set(sum(map(feature_factory.get_feature_inputs, fea_names), [])))
+        builder.add_stage(Stage('features', 'feature_factory', 'build_features_by_name', [fea_names], inputs,
+                                ['../feature/' + name for name in fea_names],
+                                code('feature_factory', ['build_features_by_name', 'build_features']) +
+                                sorted(set(sum(map(feature_stage_code, fea_names), [])))))
+
+    for name, fea_names in concats.iteritems():
+        builder.add_stage(Stage('concat_' + name, 'feature_factory', 'concat_feature_by_name', [name, fea_names],
+                                ['../feature/' + n for n in fea_names], ['../feature/' + name],
+                                code('feature_factory', ['concat_feature_by_name', 'concat_feature', 'find_feature']) +
+                                code('feature', ['Feature.dump', 'MultiFeature.dump']) +
+                                code('utils', ['general_max', 'wrap_array'])))
+        builder.add_stage(Stage('split_' + name, 'feature_factory', 'split_dataset', [name],
+                                ['../feature/' + name, '../feature/device_id'],
+                                ['../input/' + name + suffix for suffix in
+                                 ['.train', '.test', '.train.train', '.train.valid']],
+                                code('feature_factory', ['split_dataset', 'padding_zero', 'get_subset_size'])))
+    return builder
+
+
+def resolve_target(builder, target):
+    names = builder.get_stage_names()
+    for prefix in ['', 'split_', 'feature_', 'concat_', 'ingest_']:
+        if prefix + target in names:
+            return prefix + target
+    if builder.get_producer('../feature/' + target) is not None:
+        return builder.get_producer('../feature/' + target)
+    raise KeyError('unknown target %s' % target)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='*')
+    parser.add_argument('--hash', action='store_true', help='fingerprint inputs by content instead of mtime')
+    parser.add_argument('-j', '--num_worker', type=int, default=None)
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('--fused', action='store_true', help='build all base features in one stage')
+    argv = parser.parse_args()
+
+    builder = default_builder('hash' if argv.hash else 'mtime', argv.num_worker, argv.fused)
+    if argv.list:
+        for name in builder.get_stage_names():
+            print name, ' '.join(sorted(builder.get_dependencies(name)))
+    elif len(argv.targets) > 0:
+        builder.build([resolve_target(builder, t) for t in argv.targets])
+    else:
+        builder.build()
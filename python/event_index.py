@@ -0,0 +1,385 @@
+import collections
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+path_device_event = '../data/device_event/'
+path_app_event = '../data/app_event/'
+
+time_columns = ['day', 'hour', 'minute', 'second', 'weekday', 'hour_group']
+# hour -> hour group, buckets [0, 5), [5, 9), [9, 14), [14, 19), [19, 24)
+hour_group_table = np.array([0] * 5 + [1] * 4 + [2] * 5 + [3] * 5 + [4] * 5, dtype=np.int8)
+
+
+def timestamp_2_epoch(timestamp):
+    # 'YYYY-mm-dd HH:MM:SS' strings -> seconds since epoch
+    return np.asarray(timestamp).astype('datetime64[s]').astype(np.int64)
+
+
+def epoch_2_timestamp(epoch):
+    return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def decode_time(epoch, fetch_list=time_columns):
+    epoch = np.asarray(epoch, dtype=np.int64)
+    seconds = epoch % 86400
+    res = []
+    for f in fetch_list:
+        if f == 'day':
+            date = epoch.astype('datetime64[s]').astype('datetime64[D]')
+            res.append((date - date.astype('datetime64[M]')).astype(np.int8) + 1)
+        elif f == 'hour':
+            res.append((seconds // 3600).astype(np.int8))
+        elif f == 'minute':
+            res.append((seconds // 60 % 60).astype(np.int8))
+        elif f == 'second':
+            res.append((seconds % 60).astype(np.int8))
+        elif f == 'weekday':
+            # 1970-01-01 is a Thursday, Monday is 0 as in datetime.weekday()
+            res.append(((epoch // 86400 + 3) % 7).astype(np.int8))
+        elif f == 'hour_group':
+            res.append(hour_group_table[seconds // 3600])
+        else:
+            raise ValueError('unknown time field %s' % f)
+    return res
+
+
+def dump_watermark(path, watermark):
+    with open(path + 'watermark.json', 'w') as fout:
+        json.dump(watermark, fout, indent=2)
+
+
+def load_watermark(path):
+    if not os.path.exists(path + 'watermark.json'):
+        return None
+    with open(path + 'watermark.json', 'r') as fin:
+        return json.load(fin)
+
+
+def dump_csr(path, name, mat):
+    np.save(path + name + '_data.npy', mat.data)
+    np.save(path + name + '_indices.npy', mat.indices)
+    np.save(path + name + '_indptr.npy', mat.indptr)
+    np.save(path + name + '_shape.npy', np.array(mat.shape, dtype=np.int64))
+
+
+def load_csr(path, name, mmap_mode='r'):
+    data = np.load(path + name + '_data.npy', mmap_mode=mmap_mode)
+    indices = np.load(path + name + '_indices.npy', mmap_mode=mmap_mode)
+    indptr = np.load(path + name + '_indptr.npy', mmap_mode=mmap_mode)
+    shape = tuple(np.load(path + name + '_shape.npy'))
+    return csr_matrix((data, indices, indptr), shape=shape)
+
+
+def device_time_key(indptr, timestamp, min_stamp, span):
+    # (device, timestamp) of each event as one int64, ordered like the rows of a device event index
+    device = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    return device * span + (np.asarray(timestamp, dtype=np.int64) - min_stamp)
+
+
+class DeviceEventIndex:
+    columns = ['event_id', 'timestamp', 'longitude', 'latitude'] + time_columns
+
+    def __init__(self, path=path_device_event):
+        self.__path = path
+        self.__indptr = None
+        self.__columns = {}
+        self.__watermark = None
+
+    def get_path(self):
+        return self.__path
+
+    def get_indptr(self):
+        return self.__indptr
+
+    def get_column(self, name):
+        return self.__columns[name]
+
+    def get_event_id(self):
+        return self.__columns['event_id']
+
+    def get_timestamp(self):
+        return self.__columns['timestamp']
+
+    def get_longitude(self):
+        return self.__columns['longitude']
+
+    def get_latitude(self):
+        return self.__columns['latitude']
+
+    def get_device_size(self):
+        return len(self.__indptr) - 1
+
+    def get_event_size(self):
+        return self.__indptr[-1]
+
+    def get_event_num(self, device_id=None):
+        event_num = np.diff(self.__indptr)
+        if device_id is None:
+            return event_num
+        return event_num[device_id]
+
+    def get_row(self, did):
+        return self.__indptr[did], self.__indptr[did + 1]
+
+    def get_rows(self, device_id):
+        # index rows of the events of each device, devices in the given order and events in time order
+        device_id = np.asarray(device_id, dtype=np.int64)
+        begins = self.__indptr[device_id]
+        event_num = self.__indptr[device_id + 1] - begins
+        offsets = np.arange(event_num.sum()) - np.repeat(np.cumsum(event_num) - event_num, event_num)
+        return np.repeat(begins, event_num) + offsets, event_num
+
+    def get_watermark(self):
+        return self.__watermark
+
+    def set_watermark(self, watermark):
+        self.__watermark = watermark
+
+    def has_device(self, did):
+        return 0 <= did < self.get_device_size() and self.__indptr[did + 1] > self.__indptr[did]
+
+    def set_value(self, indptr, columns):
+        self.__indptr = indptr
+        self.__columns = columns
+
+    def build(self, did, event_id, timestamp, longitude, latitude, num_device):
+        # events of unknown devices come with did < 0 and are dropped
+        did = np.asarray(did, dtype=np.int64)
+        mask = did >= 0
+        did = did[mask]
+        epoch = timestamp_2_epoch(np.asarray(timestamp)[mask])
+        # stable sort, events of one device keep their csv order on equal timestamps
+        order = np.lexsort((epoch, did))
+        indptr = np.zeros(num_device + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(did, minlength=num_device))
+        columns = {
+            'event_id': np.asarray(event_id, dtype=np.int64)[mask][order],
+            'timestamp': epoch[order],
+            'longitude': np.asarray(longitude, dtype=np.float32)[mask][order],
+            'latitude': np.asarray(latitude, dtype=np.float32)[mask][order],
+        }
+        for name, col in zip(time_columns, decode_time(columns['timestamp'])):
+            columns[name] = col
+        self.set_value(indptr, columns)
+
+    def append(self, did, event_id, timestamp, longitude, latitude, num_device):
+        # merges new events in place of a rebuild, the old events are copied once and never sorted again
+        delta = DeviceEventIndex(self.__path)
+        delta.build(did, event_id, timestamp, longitude, latitude, num_device)
+        delta_indptr = delta.get_indptr()
+        delta_timestamp = delta.get_timestamp()
+        indptr = np.asarray(self.__indptr)
+        if len(indptr) < num_device + 1:
+            indptr = np.concatenate([indptr, np.repeat(indptr[-1], num_device + 1 - len(indptr))])
+        timestamp = self.__columns['timestamp']
+
+        # old events are sorted by (device, timestamp), so one searchsorted over a (device, timestamp) key
+        # places all new events; side='right' puts them after old ones of the same device and timestamp,
+        # as in a rebuild
+        stamps = [t for t in [timestamp, delta_timestamp] if len(t) > 0]
+        min_stamp = min(map(np.min, stamps)) if len(stamps) > 0 else 0
+        span = max(map(np.max, stamps)) - min_stamp + 1 if len(stamps) > 0 else 1
+        positions = np.searchsorted(device_time_key(indptr, timestamp, min_stamp, span),
+                                    device_time_key(delta_indptr, delta_timestamp, min_stamp, span), side='right')
+        columns = {}
+        for name in self.columns:
+            columns[name] = np.insert(self.__columns[name], positions, delta.get_column(name))
+        self.set_value(indptr + delta_indptr, columns)
+
+    def get_files(self):
+        return [self.__path + name + '.npy' for name in ['indptr'] + self.columns]
+
+    def dump(self):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        print 'device event index dumped at: %s' % self.__path
+        np.save(self.__path + 'indptr.npy', self.__indptr)
+        for name in self.columns:
+            np.save(self.__path + name + '.npy', self.__columns[name])
+        # watermark goes last, an interrupted dump leaves the old one behind
+        if self.__watermark is not None:
+            dump_watermark(self.__path, self.__watermark)
+
+    def load(self, mmap_mode='r'):
+        indptr = np.load(self.__path + 'indptr.npy', mmap_mode=mmap_mode)
+        columns = {}
+        for name in self.columns:
+            columns[name] = np.load(self.__path + name + '.npy', mmap_mode=mmap_mode)
+        self.set_value(indptr, columns)
+        self.set_watermark(load_watermark(self.__path))
+
+    def as_dict(self):
+        return DeviceEventDict(self)
+
+
+class DeviceEventDict(collections.Mapping):
+    # read-only view with the layout of the old dict_device_event.pkl:
+    # did -> [(event_id, 'YYYY-mm-dd HH:MM:SS', longitude, latitude), ...] sorted by time
+    def __init__(self, index):
+        self.__index = index
+
+    def get_index(self):
+        return self.__index
+
+    def __contains__(self, did):
+        return self.__index.has_device(did)
+
+    def __getitem__(self, did):
+        if did not in self:
+            raise KeyError(did)
+        begin, end = self.__index.get_row(did)
+        event_id = self.__index.get_event_id()[begin:end]
+        timestamp = self.__index.get_timestamp()[begin:end]
+        longitude = self.__index.get_longitude()[begin:end]
+        latitude = self.__index.get_latitude()[begin:end]
+        return [(event_id[i], epoch_2_timestamp(timestamp[i]), longitude[i], latitude[i]) for i in
+                range(end - begin)]
+
+    def __iter__(self):
+        return iter(np.where(self.__index.get_event_num() > 0)[0])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.__index.get_event_num()))
+
+
+class AppEventIndex:
+    def __init__(self, path=path_app_event):
+        self.__path = path
+        self.__event_id = None
+        self.__installed = None
+        self.__active = None
+        self.__watermark = None
+
+    def get_path(self):
+        return self.__path
+
+    def get_event_id(self):
+        return self.__event_id
+
+    def get_installed(self):
+        return self.__installed
+
+    def get_active(self):
+        return self.__active
+
+    def get_event_size(self):
+        return len(self.__event_id)
+
+    def get_app_size(self):
+        return self.__installed.shape[1]
+
+    def get_watermark(self):
+        return self.__watermark
+
+    def set_watermark(self, watermark):
+        self.__watermark = watermark
+
+    def get_rows(self, event_id):
+        # row of each event in the incidence matrices, -1 for events without app records
+        event_id = np.asarray(event_id, dtype=np.int64)
+        if len(self.__event_id) == 0:
+            # nothing ingested yet, no event has app records
+            return np.zeros(len(event_id), dtype=np.int64) - 1
+        rows = np.searchsorted(self.__event_id, event_id)
+        rows[rows == len(self.__event_id)] = 0
+        found = self.__event_id[rows] == event_id
+        return np.where(found, rows, -1)
+
+    def set_value(self, event_id, installed, active):
+        self.__event_id = event_id
+        self.__installed = installed
+        self.__active = active
+
+    def build(self, event_id, aid, is_installed, is_active, num_app):
+        event_id, rows = np.unique(np.asarray(event_id, dtype=np.int64), return_inverse=True)
+        aid = np.asarray(aid, dtype=np.int64)
+        shape = (len(event_id), num_app)
+        matrices = []
+        for flag in [is_installed, is_active]:
+            mask = np.asarray(flag) > 0
+            mat = csr_matrix((np.ones(np.count_nonzero(mask), dtype=np.int32), (rows[mask], aid[mask])), shape=shape)
+            mat.sum_duplicates()
+            mat.data[:] = 1
+            matrices.append(mat)
+        self.set_value(event_id, matrices[0], matrices[1])
+
+    def append(self, event_id, aid, is_installed, is_active, num_app):
+        # events seen before get the union of their old and new apps
+        delta = AppEventIndex(self.__path)
+        delta.build(event_id, aid, is_installed, is_active, num_app)
+        event_id = np.union1d(self.__event_id, delta.get_event_id())
+        old_rows = np.searchsorted(event_id, self.__event_id)
+        delta_rows = np.searchsorted(event_id, delta.get_event_id())
+        shape = (len(event_id), num_app)
+        matrices = []
+        for old, new in [(self.__installed, delta.get_installed()), (self.__active, delta.get_active())]:
+            old = old.tocoo()
+            new = new.tocoo()
+            rows = np.concatenate([old_rows[old.row], delta_rows[new.row]])
+            cols = np.concatenate([old.col, new.col])
+            mat = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=shape)
+            mat.sum_duplicates()
+            mat.data[:] = 1
+            matrices.append(mat)
+        self.set_value(event_id, matrices[0], matrices[1])
+
+    def get_files(self):
+        files = [self.__path + 'event_id.npy']
+        for name in ['installed', 'active']:
+            files.extend([self.__path + name + '_' + part + '.npy' for part in ['data', 'indices', 'indptr', 'shape']])
+        return files
+
+    def dump(self):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        print 'app event index dumped at: %s' % self.__path
+        np.save(self.__path + 'event_id.npy', self.__event_id)
+        dump_csr(self.__path, 'installed', self.__installed)
+        dump_csr(self.__path, 'active', self.__active)
+        if self.__watermark is not None:
+            dump_watermark(self.__path, self.__watermark)
+
+    def load(self, mmap_mode='r'):
+        event_id = np.load(self.__path + 'event_id.npy', mmap_mode=mmap_mode)
+        installed = load_csr(self.__path, 'installed', mmap_mode)
+        active = load_csr(self.__path, 'active', mmap_mode)
+        self.set_value(event_id, installed, active)
+        self.set_watermark(load_watermark(self.__path))
+
+    def as_dict(self):
+        return AppEventDict(self)
+
+
+class AppEventDict(collections.Mapping):
+    # read-only view with the layout of the old dict_app_event.pkl:
+    # event_id -> (installed app set, active app set)
+    def __init__(self, index):
+        self.__index = index
+
+    def get_index(self):
+        return self.__index
+
+    def get_row(self, eid):
+        return self.__index.get_rows([eid])[0]
+
+    def __contains__(self, eid):
+        return self.get_row(eid) >= 0
+
+    def __getitem__(self, eid):
+        row = self.get_row(eid)
+        if row < 0:
+            raise KeyError(eid)
+        installed = self.__index.get_installed()
+        active = self.__index.get_active()
+        return (set(installed.indices[installed.indptr[row]:installed.indptr[row + 1]]),
+                set(active.indices[active.indptr[row]:active.indptr[row + 1]]))
+
+    def __iter__(self):
+        return iter(self.__index.get_event_id())
+
+    def __len__(self):
+        return self.__index.get_event_size()
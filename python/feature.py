@@ -1,8 +1,65 @@
+from multiprocessing import Pool
+
 import numpy as np
 
 import feature_impl
 import utils
 
+# proc and arguments of the sharded process in progress, forked workers read them from here
+shard_proc = None
+shard_argv = None
+
+
+def get_shard_weights(argv):
+    # a device weighs its event number, so the few devices with tens of thousands of events spread out
+    device_id = argv['device_id']
+    dict_device_event = argv.get('dict_device_event')
+    if hasattr(dict_device_event, 'get_index'):
+        return dict_device_event.get_index().get_event_num(device_id) + 1
+    return np.ones(len(device_id), dtype=np.int64)
+
+
+def split_shards(weights, num_shard):
+    # contiguous (begin, end) ranges of about equal total weight
+    cum_weights = np.cumsum(weights)
+    bounds = np.searchsorted(cum_weights, cum_weights[-1] * np.arange(1, num_shard) / float(num_shard))
+    bounds = np.unique(np.concatenate([[0], bounds, [len(weights)]]))
+    return zip(bounds[:-1], bounds[1:])
+
+
+def process_shard(bounds):
+    begin, end = bounds
+    argv = dict(shard_argv)
+    argv['device_id'] = shard_argv['device_id'][begin:end]
+    return shard_proc(**argv)
+
+
+def concat_shards(parts):
+    if all(isinstance(p, np.ndarray) and p.dtype != object and p.shape[1:] == parts[0].shape[1:] for p in parts):
+        return np.concatenate(parts)
+    # ragged rows, rebuilt the way a proc builds them from a list
+    rows = []
+    for p in parts:
+        rows.extend(p)
+    return np.array(rows)
+
+
+def process_sharded(proc, argv, num_worker, shard_per_worker=4):
+    # device_id is split into shards balanced by event number, the loaded data reaches the workers through fork
+    global shard_proc, shard_argv
+    shard_proc = proc
+    shard_argv = argv
+    shards = split_shards(get_shard_weights(argv), num_worker * shard_per_worker)
+    pool = Pool(num_worker)
+    try:
+        parts = pool.map(process_shard, shards, 1)
+    finally:
+        pool.close()
+        pool.join()
+        shard_proc = None
+        shard_argv = None
+    return concat_shards(map(lambda x: x[0], parts)), concat_shards(map(lambda x: x[1], parts))
+
 
 class Feature:
     def __init__(self, name=None, ftype=None, dtype=None, space=None, rank=None, size=None):
@@ -21,6 +78,9 @@ class Feature:
         self.__sub_features = None
         self.__sub_spaces = None
         self.__sub_ranks = None
+        self.__num_worker = None
+        self.__cache = None
+        self.__inputs = None
 
     def get_name(self):
         return self.__name
@@ -73,8 +133,39 @@ class Feature:
     def get_sub_ranks(self):
         return self.__sub_ranks
 
+    def set_num_worker(self, num_worker):
+        self.__num_worker = num_worker
+
+    def get_num_worker(self):
+        return self.__num_worker
+
+    def set_cache(self, cache, inputs):
+        # inputs are the data files behind argv, without them nothing is cached
+        self.__cache = cache
+        self.__inputs = inputs
+
+    def get_cache(self):
+        return self.__cache
+
+    def is_shardable(self):
+        return self.__proc is not None and self.__proc.__name__[:-len('_proc')] in feature_impl.row_local_procs
+
     def process(self, **argv):
-        self.__indices, self.__values = self.__proc(**argv)
+        key = None
+        if self.__cache is not None and self.__inputs is not None:
+            code = feature_impl.get_proc_code(self.__proc.__name__[:-len('_proc')])
+            key = self.__cache.get_key(self.__name, code, argv, self.__inputs)
+            value = self.__cache.get(self.__name, key)
+            if value is not None:
+                self.__indices, self.__values = value
+                return
+        # only row local procs over device_id can be sharded, the others run in this process
+        if self.__num_worker > 1 and self.is_shardable() and len(argv['device_id']) > 0:
+            self.__indices, self.__values = process_sharded(self.__proc, argv, self.__num_worker)
+        else:
+            self.__indices, self.__values = self.__proc(**argv)
+        if key is not None:
+            self.__cache.put(key, (self.__indices, self.__values))
 
     def set_value(self, indices=None, values=None):
         if indices is not None:
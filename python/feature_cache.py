@@ -0,0 +1,140 @@
+import cPickle as pkl
+import fcntl
+import hashlib
+import importlib
+import inspect
+import json
+import os
+
+path_feature_cache = '../feature/cache/'
+
+
+def file_fingerprint(path):
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return '%d:%d' % (st.st_size, int(st.st_mtime * 1000))
+
+
+def code_source(code):
+    # source of (module, function) pairs, dotted names are methods
+    return ''.join([inspect.getsource(reduce(getattr, func.split('.'), importlib.import_module(module)))
+                    for module, func in code])
+
+
+class FeatureCache:
+    # computed (indices, values) of procs, keyed by proc name, code, parameters and input files,
+    # least recently used entries are evicted once the cache is over its size budget
+    def __init__(self, path=path_feature_cache, budget=4 << 30):
+        self.__path = path
+        self.__budget = budget
+
+    def get_path(self):
+        return self.__path
+
+    def get_budget(self):
+        return self.__budget
+
+    def set_budget(self, budget):
+        self.__budget = budget
+
+    def get_key(self, name, code, argv, inputs):
+        # code is the proc and the kernels it calls (feature_impl.get_proc_code), as in the build fingerprints
+        md5 = hashlib.md5()
+        md5.update(name + '\n')
+        md5.update(code_source(code))
+        for arg in sorted(argv.keys()):
+            value = argv[arg]
+            # data arguments are covered by the input files, plain parameters by their value
+            if isinstance(value, (int, long, float, str, tuple)):
+                md5.update('%s=%r\n' % (arg, value))
+            else:
+                md5.update('%s\n' % arg)
+        for path in sorted(inputs):
+            md5.update('%s=%s\n' % (path, file_fingerprint(path)))
+        return md5.hexdigest()
+
+    def get_entry_path(self, key):
+        return self.__path + key + '.pkl'
+
+    def get(self, name, key):
+        path = self.get_entry_path(key)
+        if not os.path.exists(path):
+            self.record(name, 'miss')
+            return None
+        with open(path, 'rb') as fin:
+            value = pkl.load(fin)
+        # mtime is the last use, eviction goes by it
+        os.utime(path, None)
+        self.record(name, 'hit')
+        return value
+
+    def put(self, key, value):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        path = self.get_entry_path(key)
+        with open(path + '.tmp', 'wb') as fout:
+            pkl.dump(value, fout, pkl.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+        self.evict()
+
+    def get_entries(self):
+        # (last use, size, path) of all entries, oldest first
+        if not os.path.exists(self.__path):
+            return []
+        entries = []
+        for fn in os.listdir(self.__path):
+            if fn.endswith('.pkl'):
+                st = os.stat(self.__path + fn)
+                entries.append((st.st_mtime, st.st_size, self.__path + fn))
+        return sorted(entries)
+
+    def get_size(self):
+        return sum(map(lambda x: x[1], self.get_entries()))
+
+    def evict(self):
+        entries = self.get_entries()
+        total = sum(map(lambda x: x[1], entries))
+        # the newest entry always stays, even alone over budget
+        for _, size, path in entries[:-1]:
+            if total <= self.__budget:
+                break
+            os.remove(path)
+            total -= size
+            print 'feature cache evicted', path
+
+    def clear(self):
+        for _, _, path in self.get_entries():
+            os.remove(path)
+
+    def get_stats(self):
+        # feature name -> {'hit': n, 'miss': n}, kept across runs and read fresh as other runs add to it
+        if not os.path.exists(self.__path + 'stats.json'):
+            return {}
+        with open(self.__path + 'stats.json', 'r') as fin:
+            return json.load(fin)
+
+    def record(self, name, event):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        # concurrent builds share the stats file: the read-modify-write holds a lock, and the new stats are
+        # renamed into place so get_stats never reads a half written file
+        with open(self.__path + 'stats.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self.get_stats()
+            if name not in stats:
+                stats[name] = {'hit': 0, 'miss': 0}
+            stats[name][event] += 1
+            tmp = self.__path + 'stats.json.%d' % os.getpid()
+            with open(tmp, 'w') as fout:
+                json.dump(stats, fout, indent=2, sort_keys=True)
+            os.rename(tmp, self.__path + 'stats.json')
+        print 'feature cache', event, name
+
+
+if __name__ == '__main__':
+    cache = FeatureCache()
+    stats = cache.get_stats()
+    for name in sorted(stats.keys()):
+        print name, 'hit', stats[name]['hit'], 'miss', stats[name]['miss']
+    print 'entries', len(cache.get_entries()), 'size', cache.get_size()
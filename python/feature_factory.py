@@ -1,12 +1,18 @@
 import cPickle as pkl
+import inspect
+import os
 import time
 
 import numpy as np
 from scipy.sparse import csr_matrix
 
+import event_index
 import feature
+import feature_cache
+import feature_impl
 import tf_idf
 import utils
+import vocab
 
 data_app_events = '../data/raw/app_events.csv'
 data_app_labels = '../data/raw/app_labels.csv'
@@ -17,21 +23,33 @@ data_label_categories = '../data/raw/label_categories.csv'
 data_phone_brand_device_model = '../data/raw/phone_brand_device_model.csv'
 data_sample_submission = '../data/raw/sample_submission.csv'
 
+# event level dataset, one row per event of the devices in ../feature/device_id
+path_event_data = '../feature/event/'
+event_columns = ['did', 'event_id', 'label', 'row']
+
+
+def encode_device_id(map_device, device_id):
+    dids, missing = map_device.encode_mask(device_id)
+    if missing.any():
+        raise KeyError(device_id[missing][0])
+    return dids
+
 
 def read_data():
-    dict_device = pkl.load(open('../data/dict_id_device.pkl', 'rb'))
+    map_device = vocab.load_id_map('device')
     groups = ['F23-', 'F24-26', 'F27-28', 'F29-32', 'F33-42', 'F43+', 'M22-', 'M23-26', 'M27-28', 'M29-31', 'M32-38',
               'M39+']
-    group_id = {}
-    for i, v in enumerate(groups):
-        group_id[v] = i
     train_data = np.loadtxt(data_gender_age_train, delimiter=',', skiprows=1, usecols=[0, 3],
                             dtype=[('device_id', np.int64), ('group', 'S10')])
     test_data = np.loadtxt(data_gender_age_test, delimiter=',', skiprows=1, dtype=np.int64)
-    train_device_id = map(lambda d: dict_device[d], train_data['device_id'])
-    train_label = map(lambda d: group_id[d], train_data['group'])
-    test_device_id = map(lambda d: dict_device[d], test_data)
-    return np.array(train_device_id), np.array(train_label), np.array(test_device_id)
+    train_device_id = encode_device_id(map_device, train_data['device_id'])
+    group_id = {}
+    for i, v in enumerate(groups):
+        group_id[v] = i
+    train_group, train_label = np.unique(train_data['group'], return_inverse=True)
+    train_label = np.array([group_id[g] for g in train_group])[train_label]
+    test_device_id = encode_device_id(map_device, test_data)
+    return train_device_id, train_label, test_device_id
 
 
 def gather_device_id():
@@ -59,22 +77,39 @@ def get_subset_size():
 
 def gather_event_id():
     device_data = np.loadtxt('../feature/device_id', skiprows=1, dtype=np.int64, delimiter=',')
-    dict_device_event = pkl.load(open('../data/dict_device_event.pkl'))
+    device_event_index = event_index.DeviceEventIndex()
+    device_event_index.load()
     train_device_size, test_device_size = get_subset_size()
-    event_data = []
-    for did, dlabel in device_data[:train_device_size]:
-        if did in dict_device_event:
-            eids = map(lambda x: x[0], dict_device_event[did])
-            event_data.extend(map(lambda x: [did, x, dlabel], eids))
-    train_size = len(event_data)
-    for did, dlabel in device_data[train_device_size:]:
-        if did in dict_device_event:
-            eids = map(lambda x: x[0], dict_device_event[did])
-            event_data.extend(map(lambda x: [did, x, dlabel], eids))
-    event_data = np.array(event_data)
-    test_size = len(event_data) - train_size
-    print train_size, test_size, event_data.shape
-    np.savetxt('../feature/event_id', event_data, header='%d,%d' % (train_size, test_size), fmt='%d,%d,%d')
+    dids = device_data[:, 0]
+    rows, event_num = device_event_index.get_rows(dids)
+    train_size = event_num[:train_device_size].sum()
+    test_size = len(rows) - train_size
+    print train_size, test_size, len(rows)
+
+    if not os.path.exists(path_event_data):
+        os.makedirs(path_event_data)
+    columns = {
+        'did': np.repeat(dids, event_num),
+        'event_id': np.asarray(device_event_index.get_event_id()[rows]),
+        'label': np.repeat(device_data[:, 1], event_num),
+        'row': rows,
+    }
+    for name in event_columns:
+        np.save(path_event_data + name + '.npy', columns[name])
+    np.save(path_event_data + 'subset_size.npy', np.array([train_size, test_size], dtype=np.int64))
+
+
+def get_event_files():
+    return [path_event_data + name + '.npy' for name in event_columns + ['subset_size']]
+
+
+def get_event_subset_size():
+    train_size, test_size = np.load(path_event_data + 'subset_size.npy')
+    return train_size, test_size
+
+
+def load_event_data(name, mmap_mode='r'):
+    return np.load(path_event_data + name + '.npy', mmap_mode=mmap_mode)
 
 
 fea_phone_brand_embedding = feature.MultiFeature(name='phone_brand_embedding_1', dtype='f')
@@ -251,19 +286,134 @@ fea_concat_23_freq_net2net_mlp_39 = feature.MultiFeature(name='concat_23_freq_ne
 fea_concat_24_freq_net2net_mlp_1024 = feature.MultiFeature(name='concat_24_freq_net2net_mlp_1024', dtype='f')
 fea_concat_25_diff_net2net_mlp_1 = feature.MultiFeature(name='concat_25_diff_net2net_mlp_1', dtype='f')
 
+def load_device_event():
+    device_event_index = event_index.DeviceEventIndex()
+    device_event_index.load()
+    return device_event_index.as_dict()
+
+
+def load_app_event():
+    app_event_index = event_index.AppEventIndex()
+    app_event_index.load()
+    return app_event_index.as_dict()
+
+
+def load_pkl(path):
+    return pkl.load(open(path, 'rb'))
+
+
+# proc argument name -> (files the data is read from, loader)
+data_sources = {
+    'device_id': (['../feature/device_id'],
+                  lambda: np.loadtxt('../feature/device_id', dtype=np.int64, skiprows=1, delimiter=',', usecols=[0])),
+    'event_id': ([path_event_data + 'event_id.npy'], lambda: load_event_data('event_id')),
+    'event_row': ([path_event_data + 'row.npy'], lambda: load_event_data('row')),
+    'dict_device_event': (event_index.DeviceEventIndex().get_files(), load_device_event),
+    'dict_app_event': (event_index.AppEventIndex().get_files(), load_app_event),
+    'dict_app_label': (['../data/dict_app_label.pkl'], lambda: load_pkl('../data/dict_app_label.pkl')),
+    'dict_label_category_group': (['../data/label_category_group_number.npy'],
+                                  lambda: np.load('../data/label_category_group_number.npy')),
+    'dict_label_cluster_40': (['../data/dict_label_cluster_40.pkl'],
+                              lambda: load_pkl('../data/dict_label_cluster_40.pkl')),
+    'dict_label_cluster_100': (['../data/dict_label_cluster_100.pkl'],
+                               lambda: load_pkl('../data/dict_label_cluster_100.pkl')),
+    'dict_label_cluster_270': (['../data/dict_label_cluster_270.pkl'],
+                               lambda: load_pkl('../data/dict_label_cluster_270.pkl')),
+    'dict_device_brand_model': (['../data/dict_device_brand_model.pkl'],
+                                lambda: load_pkl('../data/dict_device_brand_model.pkl')),
+    'dict_event': (['../data/dict_event.pkl'], lambda: load_pkl('../data/dict_event.pkl')),
+}
+
+
+def find_feature(name):
+    for v in globals().values():
+        if isinstance(v, feature.Feature) and v.get_name() == name:
+            return v
+    raise KeyError('unknown feature %s' % name)
+
+
+def get_proc_args(name):
+    return inspect.getargspec(getattr(feature_impl, name + '_proc')).args
+
+
+def get_feature_inputs(name):
+    inputs = []
+    for arg in get_proc_args(name):
+        inputs.extend(data_sources[arg][0])
+    return inputs
+
+
+def build_feature(name, num_worker=None, cache=True):
+    # loads exactly the data the proc asks for by argument name
+    fea = find_feature(name)
+    fea.set_num_worker(num_worker)
+    if cache:
+        fea.set_cache(feature_cache.FeatureCache(), get_feature_inputs(name))
+    args = get_proc_args(name)
+    for arg in args:
+        if arg not in data_sources:
+            raise ValueError('feature %s needs %s, which has no data source' % (name, arg))
+    print 'loading data...', ','.join(args)
+    start_time = time.time()
+    argv = {}
+    for arg in args:
+        argv[arg] = data_sources[arg][1]()
+    print 'finish in %d sec' % (time.time() - start_time)
+
+    fea.process(**argv)
+    fea.dump()
+
+
+def build_features(fea_list, cache=True):
+    # one load of the data all procs ask for, procs with the same arguments run back to back so the
+    # intermediates they share (feature_impl.kernel_cache) are computed once
+    names = map(lambda x: x.get_name(), fea_list)
+    if cache:
+        cache = feature_cache.FeatureCache()
+        for fea in fea_list:
+            fea.set_cache(cache, get_feature_inputs(fea.get_name()))
+    args = sorted(set(sum(map(get_proc_args, names), [])))
+    for arg in args:
+        if arg not in data_sources:
+            raise ValueError('%s has no data source' % arg)
+    print 'loading data...', ','.join(args)
+    start_time = time.time()
+    argv = {}
+    for arg in args:
+        argv[arg] = data_sources[arg][1]()
+    print 'finish in %d sec' % (time.time() - start_time)
+
+    order = sorted(range(len(fea_list)), key=lambda x: (get_proc_args(names[x]), x))
+    for i in order:
+        start_time = time.time()
+        fea_list[i].process(**dict([(arg, argv[arg]) for arg in get_proc_args(names[i])]))
+        fea_list[i].dump()
+        print names[i], 'finish in %d sec' % (time.time() - start_time)
+    feature_impl.kernel_cache.clear()
+
+
+def build_features_by_name(names):
+    build_features(map(find_feature, names))
+
+
 def make_feature():
     print 'loading data...'
     start_time = time.time()
 
     # dict_device_brand_model = pkl.load(open('../data/dict_device_brand_model.pkl', 'rb'))
-    dict_device_event = pkl.load(open('../data/dict_device_event.pkl', 'rb'))
-    dict_app_event = pkl.load(open('../data/dict_app_event.pkl', 'rb'))
+    device_event_index = event_index.DeviceEventIndex()
+    device_event_index.load()
+    dict_device_event = device_event_index.as_dict()
+    app_event_index = event_index.AppEventIndex()
+    app_event_index.load()
+    dict_app_event = app_event_index.as_dict()
     dict_app_label = pkl.load(open('../data/dict_app_label.pkl', 'rb'))
     # dict_event = pkl.load(open('../data/dict_event.pkl', 'rb'))
     # dict_brand = pkl.load(open('../data/dict_id_brand.pkl', 'rb'))
     # dict_model = pkl.load(open('../data/dict_id_model.pkl', 'rb'))
     # dict_app = pkl.load(open('../data/dict_id_app.pkl', 'rb'))
-    dict_label_category_group = pkl.load(open('../data/dict_label_category_group_number.pkl', 'rb'))
+    # label id -> category group number, indexed like the old dict
+    dict_label_category_group = np.load('../data/label_category_group_number.npy')
     # dict_label_cluster_40 = pkl.load(open('../data/dict_label_cluster_40.pkl', 'rb'))
     # dict_label_cluster_100 = pkl.load(open('../data/dict_label_cluster_100.pkl', 'rb'))
     # dict_label_cluster_270 = pkl.load(open('../data/dict_label_cluster_270.pkl', 'rb'))
@@ -394,6 +544,10 @@ def concat_feature(name, fea_list):
     fea_concat.dump(extra=extra)
 
 
+def concat_feature_by_name(name, fea_names):
+    concat_feature(name, [find_feature(n) for n in fea_names])
+
+
 def padding_zero(line, space):
     line_space = int(line.strip().split()[-1].split(':')[0]) + 1
     if line_space < space:
@@ -1,6 +1,90 @@
-from datetime import datetime
-
 import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+import event_index
+import normalizer
+import utils
+
+# procs whose rows depend only on their own device, so device_id can be split into shards and the parts
+# concatenated; procs fitting statistics over all devices (e.g. device_long_lat_norm) are left out
+row_local_procs = set([
+    'phone_brand', 'device_model',
+    'installed_app', 'active_app', 'installed_app_freq', 'active_app_num', 'active_app_freq',
+    'installed_app_label', 'active_app_label', 'installed_app_label_freq', 'installed_app_label_num',
+    'active_app_label_freq', 'active_app_label_num',
+    'active_app_label_cluster_40', 'active_app_label_cluster_40_num', 'active_app_label_cluster_100',
+    'active_app_label_cluster_270', 'active_app_label_category', 'active_app_label_category_num',
+    'active_app_label_each_hour_category', 'active_app_label_each_hour_category_num',
+    'active_app_label_each_hour_category_freq', 'active_app_label_diff_hour_category',
+    'active_app_label_diff_hour_category_num', 'active_app_label_diff_hour_category_freq',
+    'device_event_num', 'device_day_event_num', 'device_day_event_num_freq', 'device_weekday_event_num',
+    'device_weekday_event_num_freq', 'device_hour_event_num', 'device_hour_event_num_freq',
+    'device_day_hour_event_num', 'device_long_lat',
+])
+
+
+def kernel_code(module, funcs):
+    return [(module, f) for f in funcs]
+
+
+# (module, function) pairs each proc calls besides itself, the build fingerprints and the feature cache keys
+# cover exactly these, so editing a kernel only invalidates the procs using it; dotted names are methods
+device_rows_code = [('event_index', 'DeviceEventIndex.get_rows')]
+app_code = device_rows_code + [('event_index', 'AppEventIndex.get_rows')] + kernel_code('feature_impl', [
+    'csr_2_feature', 'cached_kernel', 'device_app_count', 'compute_device_app_count', 'csr_binary', 'csr_freq',
+    'device_app_matrix'])
+label_code = app_code + [('utils', 'dict_2_csr')] + kernel_code('feature_impl', [
+    'csr_row_freq', 'app_label_matrix', 'device_label_count', 'compute_device_label_count',
+    'device_app_label_matrix'])
+label_group_code = label_code + kernel_code('feature_impl', [
+    'label_group_matrix', 'device_label_group_count', 'device_label_group_matrix'])
+time_group_code = device_rows_code + [('event_index', 'AppEventIndex.get_rows'), ('utils', 'dict_2_csr')] + \
+    kernel_code('feature_impl', ['csr_2_feature', 'cached_kernel', 'csr_binary', 'csr_row_freq', 'app_label_matrix',
+                                 'label_group_matrix', 'event_label_count', 'device_time_group_count',
+                                 'device_time_group_matrix'])
+activity_code = device_rows_code + kernel_code('feature_impl', [
+    'csr_2_feature', 'cached_kernel', 'csr_row_freq', 'activity_histogram', 'compute_device_activity',
+    'device_activity_matrix'])
+geo_code = device_rows_code + kernel_code('feature_impl', ['csr_2_feature', 'segment_stats', 'device_geo_stats'])
+norm_code = kernel_code('feature_impl', ['is_num_feature', 'feature_2_csr', 'normalize_feature']) + \
+    [('normalizer', 'Normalizer')]
+
+proc_kernels = dict(
+    [(name, app_code) for name in ['installed_app', 'active_app', 'installed_app_freq', 'active_app_num',
+                                   'active_app_freq']] +
+    [(name, label_code) for name in ['installed_app_label', 'active_app_label', 'installed_app_label_freq',
+                                     'installed_app_label_num', 'active_app_label_freq', 'active_app_label_num']] +
+    [(name, label_group_code) for name in ['active_app_label_cluster_40', 'active_app_label_cluster_40_num',
+                                           'active_app_label_cluster_100', 'active_app_label_cluster_270',
+                                           'active_app_label_category', 'active_app_label_category_num']] +
+    [(name, time_group_code) for name in ['active_app_label_each_hour_category',
+                                          'active_app_label_each_hour_category_num',
+                                          'active_app_label_each_hour_category_freq',
+                                          'active_app_label_diff_hour_category',
+                                          'active_app_label_diff_hour_category_num',
+                                          'active_app_label_diff_hour_category_freq']] +
+    [(name, activity_code) for name in ['device_day_event_num', 'device_day_event_num_freq',
+                                        'device_weekday_event_num', 'device_weekday_event_num_freq',
+                                        'device_hour_event_num', 'device_hour_event_num_freq',
+                                        'device_day_hour_event_num']] +
+    [(name, geo_code) for name in ['device_long_lat', 'device_long_lat_norm']] +
+    [(name, norm_code + [('normalizer', 'MaxNormalizer')]) for name in
+     ['device_event_num_norm', 'device_day_event_num_norm', 'device_weekday_event_num_norm',
+      'device_hour_event_num_norm', 'device_day_hour_event_num_norm']] +
+    [(name, norm_code + [('normalizer', 'MinMaxNormalizer')]) for name in
+     ['event_longitude_norm', 'event_latitude_norm']] +
+    [('event_installed_app_norm', norm_code + [('normalizer', 'RowSumNormalizer')]),
+     ('device_event_num', [('event_index', 'DeviceEventIndex.get_event_num')]),
+     ('event_installed_app', [('event_index', 'AppEventIndex.get_rows')])])
+
+
+def get_proc_code(name):
+    # the proc itself and the kernels it calls, without duplicates and in a fixed order
+    code = [('feature_impl', name + '_proc')]
+    for pair in proc_kernels.get(name, []):
+        if pair not in code:
+            code.append(pair)
+    return code
 
 
 def phone_brand_proc(device_id, dict_device_brand_model):
@@ -17,980 +101,540 @@ def device_model_proc(device_id, dict_device_brand_model):
     return indices, values
 
 
-def installed_app_proc(device_id, dict_device_event, dict_app_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                tmp = tmp | dict_app_event[eid][0]
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-
+# kernel name -> (ids of its arguments, the arguments, result) of its last call,
+# so the procs of one build share the sparse products they have in common
+kernel_cache = {}
+
+
+def cached_kernel(name, func, *args):
+    key = tuple(map(id, args))
+    if name in kernel_cache and kernel_cache[name][0] == key:
+        return kernel_cache[name][2]
+    result = func(*args)
+    # the arguments are kept alive so their ids are not reused while cached
+    kernel_cache[name] = (key, args, result)
+    return result
+
+
+def device_app_count(device_id, dict_device_event, dict_app_event):
+    return cached_kernel('device_app_count', compute_device_app_count, device_id, dict_device_event, dict_app_event)
+
+
+def compute_device_app_count(device_id, dict_device_event, dict_app_event):
+    # device x event incidence times event x app, computed once for installed and active,
+    # returned with the total event number of each device
+    device_index = dict_device_event.get_index()
+    app_index = dict_app_event.get_index()
+    rows, event_num = device_index.get_rows(device_id)
+    app_rows = app_index.get_rows(device_index.get_event_id()[rows])
+    device_rows = np.repeat(np.arange(len(event_num)), event_num)
+    # events without app records still count in event_num
+    mask = app_rows >= 0
+    incidence = csr_matrix((np.ones(np.count_nonzero(mask), dtype=np.int32), (device_rows[mask], app_rows[mask])),
+                           shape=(len(event_num), app_index.get_event_size()))
+    counts = {}
+    for name, mat in [('installed', app_index.get_installed()), ('active', app_index.get_active())]:
+        counts[name] = incidence.dot(mat).tocsr()
+        counts[name].sort_indices()
+    return counts, event_num
+
+
+def csr_binary(mat):
+    mat = mat.copy()
+    mat.data[:] = 1
+    return mat
+
+
+def csr_freq(mat, event_num):
+    mat = mat.astype(np.float64)
+    mat.data /= np.repeat(event_num, np.diff(mat.indptr))
+    return mat
+
+
+def device_app_matrix(device_id, dict_device_event, dict_app_event):
+    # binary, count and frequency variants of device x app, frequencies are over all events of a device
+    counts, event_num = device_app_count(device_id, dict_device_event, dict_app_event)
+    return {
+        'installed_app': csr_binary(counts['installed']),
+        'active_app': csr_binary(counts['active']),
+        'installed_app_num': counts['installed'],
+        'active_app_num': counts['active'],
+        'installed_app_freq': csr_freq(counts['installed'], event_num),
+        'active_app_freq': csr_freq(counts['active'], event_num),
+    }
+
+
+def csr_row_freq(mat):
+    # each row divided by its sum
+    mat = mat.astype(np.float64)
+    mat.data /= np.repeat(np.asarray(mat.sum(axis=1)).ravel(), np.diff(mat.indptr))
+    return mat
+
+
+def app_label_matrix(dict_app_label, num_app):
+    # binary app x label from the app -> label set dict, apps that never occur in events are dropped
+    num_label = max(map(lambda x: max(x) + 1 if len(x) > 0 else 0, dict_app_label.itervalues()))
+    dict_app_label = dict([(aid, lids) for aid, lids in dict_app_label.iteritems() if aid < num_app])
+    return utils.dict_2_csr(dict_app_label, (num_app, num_label))
+
+
+def device_label_count(device_id, dict_device_event, dict_app_event, dict_app_label):
+    return cached_kernel('device_label_count', compute_device_label_count, device_id, dict_device_event,
+                         dict_app_event, dict_app_label)
+
+
+def compute_device_label_count(device_id, dict_device_event, dict_app_event, dict_app_label):
+    # device x app counts times app x label, every label of an app counts once per event the app is in
+    counts, event_num = device_app_count(device_id, dict_device_event, dict_app_event)
+    app_label = app_label_matrix(dict_app_label, dict_app_event.get_index().get_app_size())
+    label_counts = {}
+    for name, mat in counts.iteritems():
+        label_counts[name] = mat.dot(app_label).tocsr()
+        label_counts[name].sort_indices()
+    return label_counts, event_num
+
+
+def device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label):
+    # set, count and frequency variants of device x label, frequencies are over all labels of a device
+    counts, _ = device_label_count(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return {
+        'installed_app_label': csr_binary(counts['installed']),
+        'active_app_label': csr_binary(counts['active']),
+        'installed_app_label_num': counts['installed'],
+        'active_app_label_num': counts['active'],
+        'installed_app_label_freq': csr_row_freq(counts['installed']),
+        'active_app_label_freq': csr_row_freq(counts['active']),
+    }
+
+
+def label_group_matrix(label_group, num_label, num_group=None):
+    # binary label x group indicator from a label -> group dict or an array of groups indexed by label
+    if isinstance(label_group, np.ndarray):
+        labels = np.arange(len(label_group))
+        groups = np.asarray(label_group, dtype=np.int64)
+    else:
+        labels = np.array(label_group.keys(), dtype=np.int64)
+        groups = np.array(label_group.values(), dtype=np.int64)
+    mask = labels < num_label
+    if num_group is None:
+        num_group = groups.max() + 1
+    return csr_matrix((np.ones(np.count_nonzero(mask), dtype=np.int32), (labels[mask], groups[mask])),
+                      shape=(num_label, num_group))
+
+
+def device_label_group_count(device_id, dict_device_event, dict_app_event, dict_app_label, label_group, app_type):
+    counts, _ = device_label_count(device_id, dict_device_event, dict_app_event, dict_app_label)
+    counts = counts[app_type]
+    group_counts = counts.dot(label_group_matrix(label_group, counts.shape[1])).tocsr()
+    group_counts.sort_indices()
+    return group_counts
+
+
+def device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label, label_group,
+                              app_type='active'):
+    # presence, count and frequency of label groups, projected from the cached device x label counts
+    group_counts = cached_kernel('device_label_group_count_' + app_type, device_label_group_count, device_id,
+                                 dict_device_event, dict_app_event, dict_app_label, label_group, app_type)
+    return {
+        'set': csr_binary(group_counts),
+        'num': group_counts,
+        'freq': csr_row_freq(group_counts),
+    }
+
+
+def event_label_count(dict_app_event, dict_app_label, app_type):
+    # rows of the app event index x label, every label of an app counts once per event
+    app_index = dict_app_event.get_index()
+    event_app = app_index.get_installed() if app_type == 'installed' else app_index.get_active()
+    mat = event_app.dot(app_label_matrix(dict_app_label, app_index.get_app_size())).tocsr()
+    mat.sort_indices()
+    return mat
+
+
+def device_time_group_count(device_id, dict_device_event, dict_app_event, dict_app_label, label_group, bucket,
+                            num_group=None, app_type='active'):
+    # device x (time bucket * num_group + group) counts, bucket is a time column of the device event index
+    # (hour, hour_group, weekday, day); events are bucketed per device first, so the rows of the product
+    # are (device, bucket) pairs and are folded into columns at the end
+    device_index = dict_device_event.get_index()
+    app_index = dict_app_event.get_index()
+    rows, event_num = device_index.get_rows(device_id)
+    buckets = device_index.get_column(bucket)[rows].astype(np.int64)
+    num_bucket = buckets.max() + 1 if len(buckets) > 0 else 1
+    app_rows = app_index.get_rows(device_index.get_event_id()[rows])
+    device_rows = np.repeat(np.arange(len(event_num)), event_num)
+    mask = app_rows >= 0
+    incidence = csr_matrix((np.ones(np.count_nonzero(mask), dtype=np.int32),
+                            (device_rows[mask] * num_bucket + buckets[mask], app_rows[mask])),
+                           shape=(len(event_num) * num_bucket, app_index.get_event_size()))
+
+    event_label = cached_kernel('event_label_count_' + app_type, event_label_count, dict_app_event, dict_app_label,
+                                app_type)
+    event_group = event_label.dot(label_group_matrix(label_group, event_label.shape[1], num_group))
+    num_group = event_group.shape[1]
+    cube = incidence.dot(event_group).tocoo()
+    mat = csr_matrix((cube.data, (cube.row // num_bucket, cube.row % num_bucket * num_group + cube.col)),
+                     shape=(len(event_num), num_bucket * num_group))
+    mat.sort_indices()
+    return mat
+
+
+def device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label, label_group, bucket,
+                             num_group=None, app_type='active'):
+    counts = cached_kernel('device_time_group_count_%s_%s' % (bucket, app_type), device_time_group_count, device_id,
+                           dict_device_event, dict_app_event, dict_app_label, label_group, bucket, num_group,
+                           app_type)
+    return {
+        'set': csr_binary(counts),
+        'num': counts,
+        'freq': csr_row_freq(counts),
+    }
+
+
+def activity_histogram(device_rows, keys, num_device):
+    # device x key event counts from (device row, key) pairs, only the pairs that occur are counted
+    num_key = keys.max() + 1 if len(keys) > 0 else 1
+    pairs, inverse = np.unique(device_rows * num_key + keys, return_inverse=True)
+    return csr_matrix((np.bincount(inverse), (pairs // num_key, pairs % num_key)), shape=(num_device, num_key))
+
+
+def compute_device_activity(device_id, dict_device_event):
+    # day, hour, weekday and day_hour histograms from one gather of the device event index columns,
+    # weekday is folded into (weekend, weekday) and has both entries for every device with events
+    index = dict_device_event.get_index()
+    rows, event_num = index.get_rows(device_id)
+    device_rows = np.repeat(np.arange(len(event_num)), event_num)
+    day = index.get_column('day')[rows].astype(np.int64)
+    hour = index.get_column('hour')[rows].astype(np.int64)
+    weekday = index.get_column('weekday')[rows] < 5
+
+    counts = {
+        'day': activity_histogram(device_rows, day, len(event_num)),
+        'hour': activity_histogram(device_rows, hour, len(event_num)),
+        'day_hour': activity_histogram(device_rows, day * 24 + hour, len(event_num)),
+    }
+    num_weekday = np.bincount(device_rows[weekday], minlength=len(event_num))
+    has_event = event_num > 0
+    weekday_counts = np.column_stack([event_num - num_weekday, num_weekday])[has_event]
+    indptr = np.zeros(len(event_num) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(has_event * 2)
+    counts['weekday'] = csr_matrix((weekday_counts.ravel(), np.tile([0, 1], np.count_nonzero(has_event)), indptr),
+                                   shape=(len(event_num), 2))
+
+    mats = {}
+    for name, mat in counts.iteritems():
+        mats[name] = {
+            'num': mat,
+            'freq': csr_row_freq(mat),
+        }
+    return mats
+
+
+def device_activity_matrix(device_id, dict_device_event):
+    return cached_kernel('device_activity', compute_device_activity, device_id, dict_device_event)
+
+
+def segment_stats(values, lengths):
+    # mean, std, max, min and median of consecutive segments of values, all segments non-empty
+    if len(lengths) == 0:
+        return np.zeros((0, 5), dtype=values.dtype)
+    starts = np.cumsum(lengths) - lengths
+    segments = np.repeat(np.arange(len(lengths)), lengths)
+    mean = np.add.reduceat(values, starts) / lengths
+    std = np.sqrt(np.add.reduceat((values - mean[segments]) ** 2, starts) / lengths)
+    # sorted within each segment, the median is the middle element or the mean of the middle two
+    ordered = values[np.lexsort((values, segments))]
+    median = (ordered[starts + (lengths - 1) // 2] + ordered[starts + lengths // 2]) / 2
+    return np.column_stack([mean, std, np.maximum.reduceat(values, starts), np.minimum.reduceat(values, starts),
+                            median])
+
+
+def device_geo_stats(device_id, dict_device_event, norm=False, mask_zero='device'):
+    # device x 10 block of longitude then latitude mean, std, max, min and median, as csr with empty rows
+    # for devices left out. mask_zero handles the (0, 0) 'no location' events: 'device' leaves out devices
+    # with no located event, 'event' also drops the (0, 0) events from the stats, None keeps everything
+    index = dict_device_event.get_index()
+    rows, event_num = index.get_rows(device_id)
+    longitude = index.get_longitude()[rows].astype(np.float64)
+    latitude = index.get_latitude()[rows].astype(np.float64)
+    located = (np.abs(longitude) >= 0.01) | (np.abs(latitude) >= 0.01)
+    if norm:
+        # global range over all events of the devices, with 0 inside it, scaled to [-1, 1]
+        for col in [longitude, latitude]:
+            min_col = min(col.min(), 0) if len(col) > 0 else 0
+            max_col = max(col.max(), 0) if len(col) > 0 else 0
+            col -= min_col
+            col /= (max_col - min_col)
+            col *= 2
+            col -= 1
+
+    device_rows = np.repeat(np.arange(len(event_num)), event_num)
+    if mask_zero == 'event':
+        keep = located
+    elif mask_zero == 'device':
+        keep = np.bincount(device_rows[located], minlength=len(event_num))[device_rows] > 0
+    else:
+        keep = np.ones(len(rows), dtype=bool)
+    lengths = np.bincount(device_rows[keep], minlength=len(event_num))
+    stats = np.hstack([segment_stats(longitude[keep], lengths[lengths > 0]),
+                       segment_stats(latitude[keep], lengths[lengths > 0])])
+    if not norm:
+        stats = stats.astype(np.float32)
+
+    indptr = np.zeros(len(event_num) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum((lengths > 0) * 10)
+    return csr_matrix((stats.ravel(), np.tile(np.arange(10), len(stats)), indptr), shape=(len(event_num), 10))
+
+
+def is_num_feature(values):
+    # a num feature has one plain value per row
+    return isinstance(values, np.ndarray) and values.dtype != object and values.ndim == 1
+
+
+def feature_2_csr(indices, values):
+    # (indices, values) of a feature as a float csr, rows in order and entries in their given order
+    if is_num_feature(values):
+        return csr_matrix((values.astype(np.float64), np.zeros(len(values), dtype=np.int64),
+                           np.arange(len(values) + 1)))
+    lengths = np.array(map(len, values), dtype=np.int64)
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(lengths)
+    if indptr[-1] == 0:
+        return csr_matrix((len(lengths), 1), dtype=np.float64)
+    data = np.concatenate([np.asarray(v, dtype=np.float64) for v in values if len(v) > 0])
+    cols = np.concatenate([np.asarray(x, dtype=np.int64) for x in indices if len(x) > 0])
+    return csr_matrix((data, cols, indptr), shape=(len(lengths), cols.max() + 1))
+
+
+def normalize_feature(name, feature_normalizer, indices, values):
+    # fitted on this feature in one pass over its data, the statistics are kept under the feature name so
+    # later rows are transformed with normalizer.load_normalizer(name) instead of refitting
+    mat = feature_2_csr(indices, values)
+    feature_normalizer.fit_transform_csr(mat)
+    feature_normalizer.dump(name)
+    if is_num_feature(values):
+        return indices, mat.data
+    return indices, np.split(mat.data, mat.indptr[1:-1])
+
+
+def csr_2_feature(mat, to_list=True):
+    # to_list=False keeps rows as arrays, so values print as numpy scalars
+    indices = np.split(mat.indices, mat.indptr[1:-1])
+    values = np.split(mat.data, mat.indptr[1:-1])
+    if to_list:
+        indices = map(lambda x: x.tolist(), indices)
+        values = map(lambda x: x.tolist(), values)
     return np.array(indices), np.array(values)
 
 
-def active_app_proc(device_id, dict_device_event, dict_app_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                tmp = tmp | dict_app_event[eid][1]
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
+def installed_app_proc(device_id, dict_device_event, dict_app_event):
+    return csr_2_feature(device_app_matrix(device_id, dict_device_event, dict_app_event)['installed_app'])
 
-    return np.array(indices), np.array(values)
+
+def active_app_proc(device_id, dict_device_event, dict_app_event):
+    return csr_2_feature(device_app_matrix(device_id, dict_device_event, dict_app_event)['active_app'])
 
 
 def installed_app_freq_proc(device_id, dict_device_event, dict_app_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][0]:
-                    if aid in tmp:
-                        tmp[aid] += 1.0
-                    else:
-                        tmp[aid] = 1.0
-        sorted_aid = sorted(tmp)
-        for i in sorted_aid:
-            tmp[i] /= len(events)
-        indices.append(sorted_aid)
-        values.append(map(lambda x: tmp[x], sorted_aid))
-    return np.array(indices), np.array(values)
+    return csr_2_feature(device_app_matrix(device_id, dict_device_event, dict_app_event)['installed_app_freq'])
 
 
 def active_app_num_proc(device_id, dict_device_event, dict_app_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    if aid in tmp:
-                        tmp[aid] += 1
-                    else:
-                        tmp[aid] = 1
-        sorted_aid = sorted(tmp)
-        indices.append(sorted_aid)
-        values.append(map(lambda x: tmp[x], sorted_aid))
-    return np.array(indices), np.array(values)
+    return csr_2_feature(device_app_matrix(device_id, dict_device_event, dict_app_event)['active_app_num'])
 
 
 def active_app_freq_proc(device_id, dict_device_event, dict_app_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    if aid in tmp:
-                        tmp[aid] += 1.0
-                    else:
-                        tmp[aid] = 1.0
-        sorted_aid = sorted(tmp)
-        for i in sorted_aid:
-            tmp[i] /= len(events)
-        indices.append(sorted_aid)
-        values.append(map(lambda x: tmp[x], sorted_aid))
-    return np.array(indices), np.array(values)
+    return csr_2_feature(device_app_matrix(device_id, dict_device_event, dict_app_event)['active_app_freq'])
 
 
 def installed_app_label_proc(device_id, dict_device_event, dict_app_event, dict_app_label):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][0]:
-                    tmp = tmp | dict_app_label[aid]
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-    return np.array(indices), np.array(values)
+    mats = device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return csr_2_feature(mats['installed_app_label'])
 
 
 def active_app_label_proc(device_id, dict_device_event, dict_app_event, dict_app_label):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    tmp = tmp | dict_app_label[aid]
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-    return np.array(indices), np.array(values)
+    mats = device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return csr_2_feature(mats['active_app_label'])
 
 
 def installed_app_label_freq_proc(device_id, dict_device_event, dict_app_event, dict_app_label):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][0]:
-                    for lid in dict_app_label[aid]:
-                        if lid in tmp:
-                            tmp[lid] += 1
-                        else:
-                            tmp[lid] = 1
-        sorted_tmp = sorted(tmp.keys())
-        total_freq = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x] * 1.0 / total_freq, sorted_tmp))
-    return np.array(indices), np.array(values)
+    mats = device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return csr_2_feature(mats['installed_app_label_freq'])
 
 
 def installed_app_label_num_proc(device_id, dict_device_event, dict_app_event, dict_app_label):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][0]:
-                    for lid in dict_app_label[aid]:
-                        if lid in tmp:
-                            tmp[lid] += 1
-                        else:
-                            tmp[lid] = 1
-        sorted_tmp = sorted(tmp.keys())
-        # total_freq = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x], sorted_tmp))
-    return np.array(indices), np.array(values)
+    mats = device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return csr_2_feature(mats['installed_app_label_num'])
 
 
 def active_app_label_freq_proc(device_id, dict_device_event, dict_app_event, dict_app_label):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        if lid in tmp:
-                            tmp[lid] += 1
-                        else:
-                            tmp[lid] = 1
-        sorted_tmp = sorted(tmp.keys())
-        total_freq = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x] * 1.0 / total_freq, sorted_tmp))
-    return np.array(indices), np.array(values)
+    mats = device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return csr_2_feature(mats['active_app_label_freq'])
 
 
 def active_app_label_num_proc(device_id, dict_device_event, dict_app_event, dict_app_label):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        if lid in tmp:
-                            tmp[lid] += 1
-                        else:
-                            tmp[lid] = 1
-        sorted_tmp = sorted(tmp.keys())
-        # total_freq = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x], sorted_tmp))
-    return np.array(indices), np.array(values)
+    mats = device_app_label_matrix(device_id, dict_device_event, dict_app_event, dict_app_label)
+    return csr_2_feature(mats['active_app_label_num'])
 
 
 def active_app_label_cluster_40_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                      dict_label_cluster_40):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_cluster = dict_label_cluster_40[lid]
-                        # if lid_group in tmp:
-                        #     tmp[lid_group] += 1
-                        # else:
-                        # tmp[lid_group] = 1
-                        tmp.add(lid_cluster)
-        # sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        # sorted_tmp = sorted(tmp.keys())
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-    return np.array(indices), np.array(values)
+    mats = device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                     dict_label_cluster_40)
+    return csr_2_feature(mats['set'])
 
 
 def active_app_label_cluster_40_num_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                          dict_label_cluster_40):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_cluster = dict_label_cluster_40[lid]
-                        if lid_cluster in tmp:
-                            tmp[lid_cluster] += 1
-                        else:
-                            tmp[lid_cluster] = 1
-                            # tmp.add(lid_cluster)
-        sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x], sorted_tmp))
-    return np.array(indices), np.array(values)
+    mats = device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                     dict_label_cluster_40)
+    return csr_2_feature(mats['num'])
 
 
 def active_app_label_cluster_100_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                       dict_label_cluster_100):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_cluster = dict_label_cluster_100[lid]
-                        # if lid_group in tmp:
-                        #     tmp[lid_group] += 1
-                        # else:
-                        # tmp[lid_group] = 1
-                        tmp.add(lid_cluster)
-        # sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        # sorted_tmp = sorted(tmp.keys())
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-    return np.array(indices), np.array(values)
+    mats = device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                     dict_label_cluster_100)
+    return csr_2_feature(mats['set'])
 
 
 def active_app_label_cluster_270_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                       dict_label_cluster_270):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_cluster = dict_label_cluster_270[lid]
-                        # if lid_group in tmp:
-                        #     tmp[lid_group] += 1
-                        # else:
-                        # tmp[lid_group] = 1
-                        tmp.add(lid_cluster)
-        # sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        # sorted_tmp = sorted(tmp.keys())
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-    return np.array(indices), np.array(values)
+    mats = device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                     dict_label_cluster_270)
+    return csr_2_feature(mats['set'])
 
 
 def active_app_label_category_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                    dict_label_category_group):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        # if lid_group in tmp:
-                        #     tmp[lid_group] += 1
-                        # else:
-                        # tmp[lid_group] = 1
-                        tmp.add(lid_group)
-        # sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        # sorted_tmp = sorted(tmp.keys())
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-    return np.array(indices), np.array(values)
+    mats = device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                     dict_label_category_group)
+    return csr_2_feature(mats['set'])
 
 
 def active_app_label_category_num_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                        dict_label_category_group):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        if lid_group in tmp:
-                            tmp[lid_group] += 1
-                        else:
-                            tmp[lid_group] = 1
-                            # tmp.add(lid_group)
-        sorted_tmp = sorted(tmp.keys())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x], sorted_tmp))
-
-    return np.array(indices), np.array(values)
+    mats = device_label_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                     dict_label_category_group)
+    return csr_2_feature(mats['num'])
 
 
 def active_app_label_each_hour_category_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                              dict_label_category_group):
     # 24 hours * 19 group numbers
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            # event_hour: the accurate part of hour when this event happen
-            event_hour = get_time(e[1], ['hour'])[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        label_hour_index = event_hour * 19 + lid_group
-                        # if label_hour_index in tmp:
-                        #     tmp[label_hour_index] += 1
-                        # else:
-                        #     tmp[label_hour_index] = 1
-                        tmp.add(label_hour_index)
-        # sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        # indices.append(sorted_tmp)
-        # values.append(map(lambda x: tmp[x] * 1.0 / total_num, sorted_tmp))
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-
-    return np.array(indices), np.array(values)
+    mats = device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                    dict_label_category_group, 'hour', 19)
+    return csr_2_feature(mats['set'])
 
 
 def active_app_label_each_hour_category_num_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                                  dict_label_category_group):
     # 24 hours * 19 group numbers
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            # event_hour: the accurate part of hour when this event happen
-            event_hour = get_time(e[1], ['hour'])[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        label_hour_index = event_hour * 19 + lid_group
-                        if label_hour_index in tmp:
-                            tmp[label_hour_index] += 1
-                        else:
-                            tmp[label_hour_index] = 1
-                            # tmp.add(label_hour_index)
-        sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x], sorted_tmp))
-        # indices.append(sorted(tmp))
-        # values.append([1] * len(tmp))
-
-    return np.array(indices), np.array(values)
+    mats = device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                    dict_label_category_group, 'hour', 19)
+    return csr_2_feature(mats['num'])
 
 
 def active_app_label_each_hour_category_freq_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                                   dict_label_category_group):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            # event_hour: the accurate part of hour when this event happen
-            event_hour = get_time(e[1], ['hour'])[0]
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        label_hour_index = event_hour * 19 + lid_group
-                        if label_hour_index in tmp:
-                            tmp[label_hour_index] += 1
-                        else:
-                            tmp[label_hour_index] = 1
-                            # tmp.add(label_hour_index)
-
-        sorted_tmp = sorted(tmp.keys())
-        total_num = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x] * 1.0 / total_num, sorted_tmp))
-        # indices.append(sorted(tmp))
-        # values.append([1] * len(tmp))
-
-    return np.array(indices), np.array(values)
+    # 24 hours * 19 group numbers
+    mats = device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                    dict_label_category_group, 'hour', 19)
+    return csr_2_feature(mats['freq'])
 
 
 def active_app_label_diff_hour_category_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                              dict_label_category_group):
     # N hour parts * 19 group numbers
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = set()
-        for e in events:
-            eid = e[0]
-            # event_hour: the accurate part of hour when this event happen
-            event_hour = change_hour_2_its_group(get_time(e[1], ['hour'])[0])
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        label_hour_index = event_hour * 19 + lid_group
-                        # if label_hour_index in tmp:
-                        #     tmp[label_hour_index] += 1
-                        # else:
-                        #     tmp[label_hour_index] = 1
-                        tmp.add(label_hour_index)
-        # sorted_tmp = sorted(tmp.keys())
-        # total_num = sum(tmp.values())
-        # indices.append(sorted_tmp)
-        # values.append(map(lambda x: tmp[x] * 1.0 / total_num, sorted_tmp))
-        indices.append(sorted(tmp))
-        values.append([1] * len(tmp))
-
-    return np.array(indices), np.array(values)
+    mats = device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                    dict_label_category_group, 'hour_group', 19)
+    return csr_2_feature(mats['set'])
 
 
 def active_app_label_diff_hour_category_num_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                                  dict_label_category_group):
     # N hour parts * 19 group numbers
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            # event_hour: the accurate part of hour when this event happen
-            event_hour = change_hour_2_its_group(get_time(e[1], ['hour'])[0])
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        label_hour_index = event_hour * 19 + lid_group
-                        if label_hour_index in tmp:
-                            tmp[label_hour_index] += 1
-                        else:
-                            tmp[label_hour_index] = 1
-        sorted_tmp = sorted(tmp.keys())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x], sorted_tmp))
-
-    return np.array(indices), np.array(values)
+    mats = device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                    dict_label_category_group, 'hour_group', 19)
+    return csr_2_feature(mats['num'])
 
 
 def active_app_label_diff_hour_category_freq_proc(device_id, dict_device_event, dict_app_event, dict_app_label,
                                                   dict_label_category_group):
     # N hour parts * 19 group numbers
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-            continue
-        events = dict_device_event[did]
-        tmp = {}
-        for e in events:
-            eid = e[0]
-            # event_hour: the accurate part of hour when this event happen
-            event_hour = change_hour_2_its_group(get_time(e[1], ['hour'])[0])
-            if eid in dict_app_event:
-                for aid in dict_app_event[eid][1]:
-                    for lid in dict_app_label[aid]:
-                        lid_group = dict_label_category_group[lid]
-                        label_hour_index = event_hour * 19 + lid_group
-                        if label_hour_index in tmp:
-                            tmp[label_hour_index] += 1
-                        else:
-                            tmp[label_hour_index] = 1
-        # sorted_tmp = sorted(tmp.keys())
-        # indices.append(sorted_tmp)
-        # values.append(map(lambda x: tmp[x], sorted_tmp))
-        sorted_tmp = sorted(tmp.keys())
-        total_num = sum(tmp.values())
-        indices.append(sorted_tmp)
-        values.append(map(lambda x: tmp[x] * 1.0 / total_num, sorted_tmp))
-
-    return np.array(indices), np.array(values)
-
-
-# used in active_app_label_group_diff_hour_freq_proc()
-def change_hour_2_its_group(x):
-    x = int(x)
-    if x < 5:
-        return 0
-    elif x < 9:
-        return 1
-    elif x < 14:
-        return 2
-    elif x < 19:
-        return 3
-    else:
-        return 4
+    mats = device_time_group_matrix(device_id, dict_device_event, dict_app_event, dict_app_label,
+                                    dict_label_category_group, 'hour_group', 19)
+    return csr_2_feature(mats['freq'])
 
 
 def device_event_num_proc(device_id, dict_device_event):
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            values.append(0)
-        else:
-            values.append(len(dict_device_event[did]))
+    values = dict_device_event.get_index().get_event_num(device_id)
     indices = np.zeros_like(values, dtype=np.int64)
     return indices, values
 
 
 def device_day_event_num_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            days = map(lambda x: get_time(x[1], ['day'])[0], dict_device_event[did])
-            tmp = {}
-            for d in days:
-                if d in tmp:
-                    tmp[d] += 1
-                else:
-                    tmp[d] = 1
-            sorted_tmp = sorted(tmp.keys())
-            indices.append(sorted_tmp)
-            values.append(map(lambda x: tmp[x], sorted_tmp))
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['day']['num'])
 
 
 def device_day_event_num_freq_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            days = map(lambda x: get_time(x[1], ['day'])[0], dict_device_event[did])
-            tmp = {}
-            for d in days:
-                if d in tmp:
-                    tmp[d] += 1.0
-                else:
-                    tmp[d] = 1.0
-            sum_tmp = sum(tmp.values())
-            sorted_tmp = sorted(tmp.keys())
-            indices.append(sorted_tmp)
-            values.append(map(lambda x: tmp[x] / sum_tmp, sorted_tmp))
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['day']['freq'])
 
 
 def device_weekday_event_num_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            weekdays = map(lambda x: get_time(x[1], ['weekday'])[0](), dict_device_event[did])
-            tmp = [0, 0]
-            for d in weekdays:
-                di = int(d < 5)
-                tmp[di] += 1
-            indices.append([0, 1])
-            values.append(tmp)
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['weekday']['num'])
 
 
 def device_weekday_event_num_freq_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            weekdays = map(lambda x: get_time(x[1], ['weekday'])[0](), dict_device_event[did])
-            tmp = [0.0, 0.0]
-            for d in weekdays:
-                di = int(d < 5)
-                tmp[di] += 1
-            tmp_sum = tmp[0] + tmp[1]
-            tmp[0] /= tmp_sum
-            tmp[1] /= tmp_sum
-            indices.append([0, 1])
-            values.append(tmp)
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['weekday']['freq'])
 
 
 def device_hour_event_num_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            hours = map(lambda x: get_time(x[1], ['hour'])[0], dict_device_event[did])
-            tmp = {}
-            for d in hours:
-                if d in tmp:
-                    tmp[d] += 1
-                else:
-                    tmp[d] = 1
-            sorted_tmp = sorted(tmp.keys())
-            indices.append(sorted_tmp)
-            values.append(map(lambda x: tmp[x], sorted_tmp))
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['hour']['num'])
 
 
 def device_hour_event_num_freq_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            hours = map(lambda x: get_time(x[1], ['hour'])[0], dict_device_event[did])
-            tmp = {}
-            for d in hours:
-                if d in tmp:
-                    tmp[d] += 1.0
-                else:
-                    tmp[d] = 1.0
-            sum_tmp = sum(tmp.values())
-            sorted_tmp = sorted(tmp.keys())
-            indices.append(sorted_tmp)
-            values.append(map(lambda x: tmp[x] / sum_tmp, sorted_tmp))
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['hour']['freq'])
 
 
 def device_day_hour_event_num_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            day_hours = map(lambda x: get_time(x[1], ['day', 'hour']), dict_device_event[did])
-            day_hours = map(lambda x: x[0] * 24 + x[1], day_hours)
-            tmp = {}
-            for dh in day_hours:
-                if dh in tmp:
-                    tmp[dh] += 1
-                else:
-                    tmp[dh] = 1
-            sorted_tmp = sorted(tmp.keys())
-            indices.append(sorted_tmp)
-            values.append(map(lambda x: tmp[x], sorted_tmp))
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_activity_matrix(device_id, dict_device_event)['day_hour']['num'])
 
 
 def device_event_num_norm_proc(indices, values):
-    norm_values = np.float64(values) / np.max(values)
-    return indices, norm_values
+    return normalize_feature('device_event_num_norm', normalizer.MaxNormalizer(), indices, values)
 
 
 def device_day_event_num_norm_proc(indices, values):
-    norm_values = []
-    max_num = 0
-    for v in values:
-        if len(v) > 0:
-            max_num = max(max_num, max(v))
-    for v in values:
-        norm_values.append(np.array(v, dtype=np.float64) / max_num)
-    return indices, norm_values
+    return normalize_feature('device_day_event_num_norm', normalizer.MaxNormalizer(), indices, values)
 
 
 def device_weekday_event_num_norm_proc(indices, values):
-    norm_values = []
-    max_num = 0
-    for v in values:
-        if len(v) > 0:
-            max_num = max(max_num, max(v))
-    for v in values:
-        norm_values.append(np.array(v, dtype=np.float64) / max_num)
-    return indices, norm_values
+    return normalize_feature('device_weekday_event_num_norm', normalizer.MaxNormalizer(), indices, values)
 
 
 def device_hour_event_num_norm_proc(indices, values):
-    norm_values = []
-    max_num = 0
-    for v in values:
-        if len(v) > 0:
-            max_num = max(max_num, max(v))
-    for v in values:
-        norm_values.append(np.array(v, dtype=np.float64) / max_num)
-    return indices, norm_values
+    return normalize_feature('device_hour_event_num_norm', normalizer.MaxNormalizer(), indices, values)
 
 
 def device_day_hour_event_num_norm_proc(indices, values):
-    norm_values = []
-    max_num = 0
-    for v in values:
-        if len(v) > 0:
-            max_num = max(max_num, max(v))
-    for v in values:
-        norm_values.append(np.array(v, dtype=np.float64) / max_num)
-    return indices, norm_values
+    return normalize_feature('device_day_hour_event_num_norm', normalizer.MaxNormalizer(), indices, values)
 
 
 def device_long_lat_proc(device_id, dict_device_event):
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            tmp = dict_device_event[did]
-            tmp_long = map(lambda x: x[2], tmp)
-            tmp_lat = map(lambda x: x[3], tmp)
-            if abs(max(tmp_long)) < 0.01 and abs(min(tmp_long)) < 0.01 and abs(max(tmp_lat)) < 0.01 and \
-                            abs(min(tmp_lat)) < 0.01:
-                indices.append([])
-                values.append([])
-            else:
-                indices.append(range(10))
-                values.append(
-                    [np.mean(tmp_long), np.std(tmp_long), np.max(tmp_long), np.min(tmp_long), np.median(tmp_long),
-                     np.mean(tmp_lat), np.std(tmp_lat), np.max(tmp_lat), np.min(tmp_lat), np.median(tmp_lat), ])
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
+    return csr_2_feature(device_geo_stats(device_id, dict_device_event), False)
 
 
 def device_long_lat_norm_proc(device_id, dict_device_event):
-    max_long = 0
-    min_long = 0
-    max_lat = 0
-    min_lat = 0
-    for did in device_id:
-        if did in dict_device_event:
-            tmp_long = map(lambda x: x[2], dict_device_event[did])
-            tmp_lat = map(lambda x: x[3], dict_device_event[did])
-            max_long = max(max_long, max(tmp_long))
-            min_long = min(min_long, min(tmp_long))
-            max_lat = max(max_lat, max(tmp_lat))
-            min_lat = min(min_lat, min(tmp_lat))
-    indices = []
-    values = []
-    for did in device_id:
-        if did not in dict_device_event:
-            indices.append([])
-            values.append([])
-        else:
-            tmp_long = np.array(map(lambda x: x[2], dict_device_event[did]), dtype=np.float64)
-            tmp_lat = np.array(map(lambda x: x[3], dict_device_event[did]), dtype=np.float64)
-            if abs(max(tmp_long)) < 0.01 and abs(min(tmp_long)) < 0.01 and abs(max(tmp_lat)) < 0.01 and \
-                            abs(min(tmp_lat)) < 0.01:
-                indices.append([])
-                values.append([])
-            else:
-                tmp_long -= min_long
-                tmp_long /= (max_long - min_long)
-                tmp_long *= 2
-                tmp_long -= 1
-                tmp_lat -= min_lat
-                tmp_lat /= (max_lat - min_lat)
-                tmp_lat *= 2
-                tmp_lat -= 1
-                indices.append(range(10))
-                values.append(
-                    [np.mean(tmp_long), np.std(tmp_long), np.max(tmp_long), np.min(tmp_long), np.median(tmp_long),
-                     np.mean(tmp_lat), np.std(tmp_lat), np.max(tmp_lat), np.min(tmp_lat), np.median(tmp_lat)])
-    indices = np.array(indices)
-    values = np.array(values)
-    return indices, values
-
+    return csr_2_feature(device_geo_stats(device_id, dict_device_event, norm=True), False)
 
-def get_time(timestamp, fetch_list):
-    date_obj = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-    res = []
-    for f in fetch_list:
-        res.append(getattr(date_obj, f))
-    return res
 
-
-def event_time_proc(event_id, dict_event):
-    indices = []
-    values = []
-    for eid in event_id:
-        day, hour, minute, second = get_time(dict_event[eid][1], ['day', 'hour', 'minute', 'second'])
-        indices.append([day, hour, minute, second])
-        values.append([1] * 4)
+def event_time_proc(event_row, dict_device_event):
+    # time fields are already decoded in the device event index, event_row points into it
+    index = dict_device_event.get_index()
+    indices = np.vstack([index.get_column(f)[event_row] for f in ['day', 'hour', 'minute', 'second']]).transpose()
     indices = np.array(indices, dtype=np.int64)
-    values = np.array(values, dtype=np.int64)
+    values = np.ones_like(indices, dtype=np.int64)
     spaces = np.max(indices, axis=0) + 1
     print spaces
     for i in range(4):
@@ -1017,15 +661,11 @@ def event_latitude_proc(event_id, dict_event):
 
 
 def event_longitude_norm_proc(indices, values):
-    values -= np.min(values)
-    values /= np.max(values)
-    return indices, values
+    return normalize_feature('event_longitude_norm', normalizer.MinMaxNormalizer(), indices, values)
 
 
 def event_latitude_norm_proc(indices, values):
-    values -= np.min(values)
-    values /= np.max(values)
-    return indices, values
+    return normalize_feature('event_latitude_norm', normalizer.MinMaxNormalizer(), indices, values)
 
 
 def event_phone_brand_proc(event_id, dict_event, dict_device_brand_model):
@@ -1036,22 +676,17 @@ def event_phone_brand_proc(event_id, dict_event, dict_device_brand_model):
 
 
 def event_installed_app_proc(event_id, dict_app_event):
-    indices = []
-    values = []
-    for eid in event_id:
-        if eid in dict_app_event:
-            tmp = sorted(dict_app_event[eid][0])
-            indices.append(tmp)
-            values.append([1] * len(tmp))
-        else:
-            indices.append([])
-            values.append([])
-
+    index = dict_app_event.get_index()
+    rows = index.get_rows(event_id)
+    # events without app records get empty rows
+    installed = diags((rows >= 0).astype(np.int32)).dot(index.get_installed()[np.maximum(rows, 0)]).tocsr()
+    installed.eliminate_zeros()
+    installed.sort_indices()
+    indices = np.split(installed.indices, installed.indptr[1:-1])
+    values = np.split(np.ones(installed.nnz, dtype=np.int64), installed.indptr[1:-1])
     return indices, values
 
 
 def event_installed_app_norm_proc(indices, values):
-    norm_values = []
-    for v in values:
-        norm_values.append(np.float64(v) / len(v))
-    return indices, np.array(norm_values)
+    # values are all ones, so the row sum is the row length
+    return normalize_feature('event_installed_app_norm', normalizer.RowSumNormalizer(), indices, values)
@@ -0,0 +1,276 @@
+import bz2
+import gzip
+import json
+import os
+import struct
+import zipfile
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+path_cache = '../data/cache/'
+
+# table name -> (raw csv, [(column, dtype)]), columns are taken from the left of each csv row
+tables = {
+    'events': ('../data/raw/events.csv',
+               [('event_id', np.int64), ('device_id', np.int64), ('timestamp', 'S19'), ('longitude', np.float32),
+                ('latitude', np.float32)]),
+    'app_events': ('../data/raw/app_events.csv',
+                   [('event_id', np.int64), ('app_id', np.int64), ('is_installed', np.int8),
+                    ('is_active', np.int8)]),
+    'app_labels': ('../data/raw/app_labels.csv',
+                   [('app_id', np.int64), ('label_id', np.int64)]),
+    'gender_age_train': ('../data/raw/gender_age_train.csv',
+                         [('device_id', np.int64), ('gender', 'S1'), ('age', np.int16), ('group', 'S10')]),
+    'gender_age_test': ('../data/raw/gender_age_test.csv',
+                        [('device_id', np.int64)]),
+    'phone_brand_device_model': ('../data/raw/phone_brand_device_model.csv',
+                                 [('device_id', np.int64)]),
+}
+
+# a raw csv may also be kept compressed next to its plain name
+compressed_suffixes = ['.gz', '.bz2', '.zip']
+# fixed npy header, long enough for any row count, so columns can be streamed before their length is known
+npy_header_size = 128
+
+
+def get_table_dir(table):
+    return path_cache + table + '/'
+
+
+def get_manifest_path(table):
+    return get_table_dir(table) + 'manifest.json'
+
+
+def find_source(path):
+    for candidate in [path] + [path + suffix for suffix in compressed_suffixes]:
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+
+def open_source(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'r')
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return archive.open(archive.namelist()[0])
+    return open(path, 'r')
+
+
+def source_stat(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime)
+
+
+def read_manifest(table):
+    path_manifest = get_manifest_path(table)
+    if not os.path.exists(path_manifest):
+        return None
+    with open(path_manifest, 'r') as fin:
+        return json.load(fin)
+
+
+def is_fresh(table):
+    manifest = read_manifest(table)
+    if manifest is None or 'source_offset' not in manifest:
+        return False
+    source = find_source(tables[table][0])
+    if not os.path.exists(source):
+        return True
+    size, mtime = source_stat(source)
+    return manifest['source'] == source and manifest['source_size'] == size and manifest['source_mtime'] == mtime
+
+
+def read_blocks(fin, block_size, complete_only=False):
+    # complete_only is for tailing a growing csv, its last line without newline is still being written
+    block = []
+    for line in fin:
+        if complete_only and not line.endswith('\n'):
+            break
+        block.append(line)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if len(block) > 0:
+        yield block
+
+
+def parse_block(lines, columns, num_fields):
+    # one split over the whole block, then every column converts in a single astype
+    # empty lines are dropped, a tail after a csv without a final newline starts with the appended newline
+    lines = [line for line in lines if line.strip('\r\n') != '']
+    text = ''.join(lines).replace('\r', '')
+    if not text.endswith('\n'):
+        # last line of a csv without a final newline
+        text += '\n'
+    fields = np.array(text.replace('\n', ',').split(',')[:-1])
+    if len(fields) != len(lines) * num_fields:
+        raise ValueError('malformed block, %d fields for %d lines of %d' % (len(fields), len(lines), num_fields))
+    fields = fields.reshape((len(lines), num_fields))
+    return [fields[:, i].astype(dtype) for i, (_, dtype) in enumerate(columns)]
+
+
+def parse_blocks(blocks, columns, num_fields, num_thread=None):
+    if not num_thread:
+        for block in blocks:
+            yield parse_block(block, columns, num_fields)
+        return
+    # the next blocks parse while the current one is consumed, at most num_thread of them are read ahead
+    pool = ThreadPool(num_thread)
+    pending = deque()
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(parse_block, (block, columns, num_fields)))
+            if len(pending) > num_thread:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def iter_source(table, offset=0, block_size=1000000, num_thread=None, complete_only=False):
+    # streams (columns of a block, offset after it) from the raw csv, offsets count uncompressed bytes
+    source, columns = tables[table]
+    source = find_source(source)
+    fin = open_source(source)
+    header = fin.readline()
+    num_fields = len(header.split(','))
+    if offset == 0:
+        offset = len(header)
+    elif source.endswith('.csv'):
+        if offset > os.path.getsize(source):
+            raise ValueError('%s is shorter than offset %d, it was rewritten' % (source, offset))
+        fin.seek(offset)
+    else:
+        skip = offset - len(header)
+        while skip > 0:
+            chunk = fin.read(min(skip, 1 << 20))
+            if len(chunk) == 0:
+                raise ValueError('%s is shorter than offset %d, it was rewritten' % (source, offset))
+            skip -= len(chunk)
+
+    ends = deque()
+
+    def blocks():
+        end = offset
+        for block in read_blocks(fin, block_size, complete_only):
+            end += sum(map(len, block))
+            ends.append(end)
+            yield block
+
+    try:
+        for data in parse_blocks(blocks(), columns, num_fields, num_thread):
+            yield data, ends.popleft()
+    finally:
+        fin.close()
+
+
+def write_npy_header(fout, dtype, rows):
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False,
+                   'shape': (rows,)})
+    header = header.ljust(npy_header_size - 11) + '\n'
+    fout.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header)
+
+
+def ingest_table(table, block_size=1000000, num_thread=None):
+    source, columns = tables[table]
+    source = find_source(source)
+    table_dir = get_table_dir(table)
+    if not os.path.exists(table_dir):
+        os.makedirs(table_dir)
+    if os.path.exists(get_manifest_path(table)):
+        os.remove(get_manifest_path(table))
+
+    print 'ingesting', source
+    size, mtime = source_stat(source)
+    files = [open(table_dir + name + '.npy', 'wb') for name, _ in columns]
+    rows = 0
+    offset = 0
+    try:
+        for fout, (_, dtype) in zip(files, columns):
+            write_npy_header(fout, dtype, 0)
+        # one pass, the row count is only known at the end and patched into the headers
+        for data, offset in iter_source(table, 0, block_size, num_thread):
+            for fout, col in zip(files, data):
+                col.tofile(fout)
+            rows += len(data[0])
+        for fout, (_, dtype) in zip(files, columns):
+            fout.seek(0)
+            write_npy_header(fout, dtype, rows)
+    finally:
+        for fout in files:
+            fout.close()
+
+    manifest = {
+        'source': source,
+        'source_size': size,
+        'source_mtime': mtime,
+        'source_offset': offset,
+        'rows': rows,
+        'columns': [[name, np.dtype(dtype).str] for name, dtype in columns],
+    }
+    # manifest is written last, an interrupted ingest is never mistaken for a complete one
+    with open(get_manifest_path(table), 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+    print table, 'rows', rows
+
+
+def read_tail(table, offset, block_size=1000000):
+    # rows appended to the raw csv after offset, up to its last complete line
+    _, columns = tables[table]
+    blocks = []
+    for data, offset in iter_source(table, offset, block_size, complete_only=True):
+        blocks.append(data)
+
+    data = {}
+    for i, (name, dtype) in enumerate(columns):
+        if len(blocks) > 0:
+            data[name] = np.concatenate([b[i] for b in blocks])
+        else:
+            data[name] = np.zeros(0, dtype=dtype)
+    return data, offset
+
+
+def load_table(table, columns=None):
+    if not is_fresh(table):
+        ingest_table(table)
+    manifest = read_manifest(table)
+    if columns is None:
+        columns = [str(name) for name, _ in manifest['columns']]
+    data = {}
+    for name in columns:
+        data[name] = np.load(get_table_dir(table) + name + '.npy', mmap_mode='r')
+    return data
+
+
+def load_column(table, column):
+    return load_table(table, [column])[column]
+
+
+def iter_blocks(table, columns=None, block_size=1000000):
+    # cached columns in row blocks, for builders that aggregate as they go
+    data = load_table(table, columns)
+    rows = len(data.values()[0])
+    for begin in range(0, rows, block_size):
+        block = {}
+        for name, col in data.iteritems():
+            block[name] = np.asarray(col[begin:begin + block_size])
+        yield block
+
+
+def unique_column(table, column, block_size=1000000):
+    unique = np.zeros(0, dtype=dict(tables[table][1])[column])
+    for block in iter_blocks(table, [column], block_size):
+        unique = np.union1d(unique, block[column])
+    return unique
+
+
+if __name__ == '__main__':
+    for t in sorted(tables.keys()):
+        if not is_fresh(t):
+            ingest_table(t)
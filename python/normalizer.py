@@ -0,0 +1,167 @@
+import json
+import os
+
+import numpy as np
+
+path_normalizer = '../data/normalizer/'
+
+
+class Normalizer:
+    # statistics are fitted on the stored entries of a csr feature (its data array and column indices) and
+    # reused for later rows; per_column keeps one statistic per column instead of one for the whole feature
+    kind = None
+
+    def __init__(self, per_column=False):
+        self.__per_column = per_column
+        self.__stats = {}
+
+    def get_per_column(self):
+        return self.__per_column
+
+    def get_stats(self):
+        return self.__stats
+
+    def set_stats(self, stats):
+        self.__stats = stats
+
+    def reduce(self, func, data, columns, init):
+        # func.at over columns when per column, else over everything; columns never seen keep init
+        if not self.__per_column:
+            return func.reduce(data) if len(data) > 0 else init
+        num_column = columns.max() + 1 if len(columns) > 0 else 0
+        res = np.zeros(num_column) + init
+        func.at(res, columns, data)
+        return res
+
+    def column_stat(self, name, columns):
+        stat = self.__stats[name]
+        if not self.__per_column:
+            return stat
+        stat = np.asarray(stat)
+        if len(columns) > 0 and columns.max() >= len(stat):
+            # columns past the fitted ones get the neutral statistic
+            stat = np.concatenate([stat, self.neutral(name, columns.max() + 1 - len(stat))])
+        return stat[columns]
+
+    def neutral(self, name, num):
+        return np.zeros(max(num, 0))
+
+    def fit(self, data, columns=None):
+        pass
+
+    def transform(self, data, columns=None):
+        # in place on a float data array
+        pass
+
+    def fit_transform(self, data, columns=None):
+        self.fit(data, columns)
+        self.transform(data, columns)
+
+    def fit_csr(self, mat):
+        self.fit(mat.data, mat.indices)
+
+    def transform_csr(self, mat):
+        self.transform(mat.data, mat.indices)
+        return mat
+
+    def fit_transform_csr(self, mat):
+        self.fit_csr(mat)
+        return self.transform_csr(mat)
+
+    def dump(self, name, path=path_normalizer):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        stats = dict([(k, np.asarray(v).tolist()) for k, v in self.__stats.iteritems()])
+        with open(path + name + '.json', 'w') as fout:
+            json.dump({'kind': self.kind, 'per_column': self.__per_column, 'stats': stats}, fout)
+
+
+class MaxNormalizer(Normalizer):
+    kind = 'max'
+
+    def fit(self, data, columns=None):
+        self.set_stats({'max': self.reduce(np.maximum, data, columns, 0)})
+
+    def transform(self, data, columns=None):
+        data /= self.column_stat('max', columns)
+
+    def neutral(self, name, num):
+        return np.ones(max(num, 0))
+
+
+class MinMaxNormalizer(Normalizer):
+    kind = 'min_max'
+
+    def fit(self, data, columns=None):
+        min_value = self.reduce(np.minimum, data, columns, np.inf)
+        max_value = self.reduce(np.maximum, data, columns, -np.inf)
+        if self.get_per_column():
+            # columns with no entries map onto themselves
+            unseen = np.isinf(min_value)
+            min_value[unseen] = 0
+            max_value[unseen] = 1
+        self.set_stats({'min': min_value, 'max': max_value})
+
+    def transform(self, data, columns=None):
+        min_value = self.column_stat('min', columns)
+        data -= min_value
+        data /= self.column_stat('max', columns) - min_value
+
+    def neutral(self, name, num):
+        return np.zeros(max(num, 0)) + (1 if name == 'max' else 0)
+
+
+class StandardNormalizer(Normalizer):
+    kind = 'standard'
+
+    def fit(self, data, columns=None):
+        if not self.get_per_column():
+            self.set_stats({'mean': data.mean(), 'std': data.std()})
+            return
+        num = np.bincount(columns)
+        total = np.bincount(columns, data, len(num))
+        mean = total / np.maximum(num, 1)
+        var = np.bincount(columns, (data - mean[columns]) ** 2, len(num)) / np.maximum(num, 1)
+        self.set_stats({'mean': mean, 'std': np.sqrt(var)})
+
+    def transform(self, data, columns=None):
+        data -= self.column_stat('mean', columns)
+        std = self.column_stat('std', columns)
+        # constant columns are only centered
+        data /= np.where(std > 0, std, 1)
+
+    def neutral(self, name, num):
+        return np.zeros(max(num, 0)) + (1 if name == 'std' else 0)
+
+
+class Log1pNormalizer(Normalizer):
+    kind = 'log1p'
+
+    def transform(self, data, columns=None):
+        np.log1p(data, out=data)
+
+
+class RowSumNormalizer(Normalizer):
+    # each row divided by its own sum, nothing to fit, works on csr only since it needs the rows
+    kind = 'row_sum'
+
+    def transform_csr(self, mat):
+        num = np.diff(mat.indptr)
+        row_sum = np.bincount(np.repeat(np.arange(mat.shape[0]), num), mat.data, mat.shape[0])
+        mat.data /= np.repeat(row_sum, num)
+        return mat
+
+
+normalizers = dict([(c.kind, c) for c in
+                    [MaxNormalizer, MinMaxNormalizer, StandardNormalizer, Log1pNormalizer, RowSumNormalizer]])
+
+
+def load_normalizer(name, path=path_normalizer):
+    with open(path + name + '.json', 'r') as fin:
+        meta = json.load(fin)
+    normalizer = normalizers[meta['kind']](meta['per_column'])
+    stats = {}
+    for k, v in meta['stats'].iteritems():
+        stats[str(k)] = np.array(v) if isinstance(v, list) else v
+    normalizer.set_stats(stats)
+    return normalizer
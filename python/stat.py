@@ -1,13 +1,20 @@
 import cPickle as pkl
+import csv
+import os
 import re
 import time
-from Queue import PriorityQueue
+from itertools import izip
+from multiprocessing import Pool
 
 import nimfa
 import numpy as np
-from scipy.sparse import csr_matrix, coo_matrix
+from scipy.sparse import csr_matrix, issparse, triu
 
+import event_index
 import feature
+import ingest
+import utils
+import vocab
 from tf_idf import tf_idf
 
 data_app_events = '../data/raw/app_events.csv'
@@ -65,8 +72,27 @@ data_sample_submission = '../data/raw/sample_submission.csv'
 # is_installed always True
 # max: 33426, min: 1, mean: 54.021451891356001
 
-def make_label_id():
-    label_a = set(np.loadtxt(data_app_labels, skiprows=1, delimiter=',', usecols=[1], dtype=np.int64))
+def load_vocabulary(name, dtype='int', extend=False):
+    vocabulary = vocab.Vocabulary(name, dtype)
+    if extend and vocabulary.exists():
+        vocabulary.load()
+        print 'extend vocabulary', name, 'size', vocabulary.get_size()
+    return vocabulary
+
+
+def dump_vocabulary(vocabulary, path_dict, path_csv, header):
+    vocabulary.dump()
+    pkl.dump(vocabulary.to_dict(), open(path_dict, 'wb'))
+    with open(path_csv, 'w') as fout:
+        fout.write(header + '\n')
+        for vid, v in enumerate(vocabulary.get_values()):
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            fout.write('%d,%s\n' % (vid, v))
+
+
+def make_label_id(extend=False):
+    label_a = set(ingest.unique_column('app_labels', 'label_id'))
     label_c = set(np.loadtxt(data_label_categories, skiprows=1, delimiter=',', usecols=[0], dtype=np.int64))
 
     print 'label id in app_label: %d', len(label_a), 'label id in label_category: %d', len(label_c)
@@ -74,60 +100,40 @@ def make_label_id():
 
     print 'app < category', label_a <= label_c
 
-    cnt = 0
-    dict = {}
-    for l in label_a:
-        dict[l] = cnt
-        cnt += 1
-
-    pkl.dump(dict, open('../data/dict_id_label.pkl', 'wb'))
-
-    with open('../data/id_label.csv', 'wb') as fout:
-        fout.write('lid,label_id\n')
+    vocab_label = load_vocabulary('label', extend=extend)
+    for block in ingest.iter_blocks('app_labels', ['label_id']):
+        vocab_label.add_all(block['label_id'])
+    dump_vocabulary(vocab_label, '../data/dict_id_label.pkl', '../data/id_label.csv', 'lid,label_id')
 
-        for k, v in dict.iteritems():
-            fout.write('%d,%d\n' % (v, k))
 
-
-def make_app_id():
-    app_l = set(np.loadtxt(data_app_labels, skiprows=1, delimiter=',', usecols=[0], dtype=np.int64))
-    app_e = set(np.loadtxt(data_app_events, skiprows=1, delimiter=',', usecols=[1], dtype=np.int64))
+def make_app_id(extend=False):
+    app_l = set(ingest.unique_column('app_labels', 'app_id'))
+    app_e = set(ingest.unique_column('app_events', 'app_id'))
 
     print '# app in app_label', len(app_l), '# app in app_event', len(app_e)
     print 'event <= label', app_e <= app_l
     print 'only build index for app having events'
 
-    cnt = 0
-    dict = {}
-    for a in app_e:
-        dict[a] = cnt
-        cnt += 1
-
-    pkl.dump(dict, open('../data/dict_id_app.pkl', 'wb'))
-
-    with open('../data/id_app.csv', 'wb') as fout:
-        fout.write('aid,app_id\n')
-
-        for k, v in dict.iteritems():
-            fout.write('%d,%d\n' % (v, k))
+    vocab_app = load_vocabulary('app', extend=extend)
+    for block in ingest.iter_blocks('app_events', ['app_id']):
+        vocab_app.add_all(block['app_id'])
+    dump_vocabulary(vocab_app, '../data/dict_id_app.pkl', '../data/id_app.csv', 'aid,app_id')
 
 
 def aggregate_app_label():
     # data_app_labels = '../data/raw/app_labels.csv'
     # each app is connected with one set, the items in the set are app labels this app has.
-    data = np.loadtxt(data_app_labels, delimiter=',', skiprows=1, dtype=np.int64)
-    print data.shape
-
-    dict_app = pkl.load(open('../data/dict_id_app.pkl'))
-    dict_label = pkl.load(open('../data/dict_id_label.pkl'))
+    map_app = vocab.load_id_map('app')
+    map_label = vocab.load_id_map('label')
 
     dict_app_label = {}
-    for i in range(len(data)):
-        app_id, label_id = data[i]
-        if app_id in dict_app:
-            aid = dict_app[app_id]
-            lid = dict_label[label_id]
+    for data in ingest.iter_blocks('app_labels'):
+        # only apps having events are indexed
+        aids = map_app.encode(data['app_id'])
+        lids = map_label.encode(data['label_id'])
+        has_app = aids >= 0
 
+        for aid, lid in izip(aids[has_app].tolist(), lids[has_app].tolist()):
             if aid in dict_app_label:
                 dict_app_label[aid].add(lid)
             else:
@@ -138,161 +144,116 @@ def aggregate_app_label():
 
 def aggregate_label_category():
     # data_label_categories = '../data/raw/label_categories.csv'
-    data = np.loadtxt(data_label_categories, delimiter=',', skiprows=1, dtype=[('label_id', int), ('category', 'S100')])
-    # print data.shape
+    with open(data_label_categories, 'r') as fin:
+        data = list(csv.reader(fin))[1:]
 
-    dict_label = pkl.load(open('../data/dict_id_label.pkl'))
-    dict_label_category = {}
+    map_label = vocab.load_id_map('label')
+    label_ids = np.array(map(lambda x: int(x[0]), data), dtype=np.int64)
+    groups = classify_categories(map(lambda x: x[1], data))
 
-    for i in range(len(data)):
-        label_id, label_category = data[i]
-        if label_id in dict_label:
-            lid = dict_label[label_id]
-            dict_label_category[lid] = change_group_name_2_number(change_category_2_group(label_category))
+    # labels without a category fall into 'Other'
+    label_category = np.zeros(map_label.get_size(), dtype=np.int8) + group_numbers['Other']
+    lids = map_label.encode(label_ids)
+    label_category[lids[lids >= 0]] = groups[lids >= 0]
 
-    pkl.dump(dict_label_category, open('../data/dict_label_category_group_number.pkl', 'wb'))
+    np.save('../data/label_category_group_number.npy', label_category)
+    pkl.dump(dict(enumerate(label_category.tolist())),
+             open('../data/dict_label_category_group_number.pkl', 'wb'))
 
 
-def change_group_name_2_number(x):
-    if x == 'Games':
-        return 0
-    elif x == 'Property':
-        return 1
-    elif x == 'Industry tag':
-        return 2
-    elif x == 'Custom':
-        return 3
-    elif x == 'Tencent':
-        return 4
-    elif x == 'Other':
-        return 5
-    elif x == 'Finance':
-        return 6
-    elif x == 'Fun':
-        return 7
-    elif x == 'Services':
-        return 8
-    elif x == 'Family':
-        return 9
-    elif x == 'Productivity':
-        return 10
-    elif x == 'Religion':
-        return 11
-    elif x == 'Video':
-        return 12
-    elif x == 'Travel':
-        return 13
-    elif x == 'Education':
-        return 14
-    elif x == 'Vitality':
-        return 15
-    elif x == 'Shopping':
-        return 16
-    elif x == 'Sports':
-        return 17
-    elif x == 'Music':
-        return 18
-    else:
-        return 5
-
+category_groups = ['Games', 'Property', 'Industry tag', 'Custom', 'Tencent', 'Other', 'Finance', 'Fun', 'Services',
+                   'Family', 'Productivity', 'Religion', 'Video', 'Travel', 'Education', 'Vitality', 'Shopping',
+                   'Sports', 'Music']
+group_numbers = dict(zip(category_groups, range(len(category_groups))))
 
-def change_category_2_group(x):
-    if re.search('([gG]am)|([pP]oker)|([cC]hess)|([pP]uzz)|([bB]all)|([pP]ursu)|([fF]ight)|([sS]imulat)|([sS]hoot)',
-                 x) is not None:
-        return ('Games')
+# (group, compiled regex or set of exact names), the first matching rule wins
+category_rules = [
+    ('Games', re.compile(
+        '([gG]am)|([pP]oker)|([cC]hess)|([pP]uzz)|([bB]all)|([pP]ursu)|([fF]ight)|([sS]imulat)|([sS]hoot)')),
     # Then I went through existing abbreviations like RPG, MMO and so on
-    elif re.search('(RPG)|(SLG)|(RAC)|(MMO)|(MOBA)', x) is not None:
-        return ('Games')
+    ('Games', re.compile('(RPG)|(SLG)|(RAC)|(MMO)|(MOBA)')),
     # Still small list of items left which is not covered by regex
-    elif x in ['billards', 'World of Warcraft', 'Tower Defense', 'Tomb', 'Ninja', 'Europe and Fantasy', 'Senki',
-               'Shushan', 'Lottery ticket', 'majiang', 'tennis', 'Martial arts']:
-        return ('Games')
-    elif x in ['Property Industry 2.0', 'Property Industry new', 'Property Industry 1.0']:
-        return ('Property')
-    elif re.search('([eE]state)', x) is not None:
-        return ('Property')
-    elif re.search(
-            '([fF]amili)|([mM]othe)|([fF]athe)|(bab)|([rR]elative)|([pP]regnan)|([pP]arent)|([mM]arriag)|([lL]ove)',
-            x) is not None:
-        return ('Family')
-    elif re.search('([fF]un)|([cC]ool)|([tT]rend)|([cC]omic)|([aA]nima)|([pP]ainti)|\
+    ('Games', {'billards', 'World of Warcraft', 'Tower Defense', 'Tomb', 'Ninja', 'Europe and Fantasy', 'Senki',
+               'Shushan', 'Lottery ticket', 'majiang', 'tennis', 'Martial arts'}),
+    ('Property', {'Property Industry 2.0', 'Property Industry new', 'Property Industry 1.0'}),
+    ('Property', re.compile('([eE]state)')),
+    ('Family', re.compile(
+        '([fF]amili)|([mM]othe)|([fF]athe)|(bab)|([rR]elative)|([pP]regnan)|([pP]arent)|([mM]arriag)|([lL]ove)')),
+    ('Fun', re.compile('([fF]un)|([cC]ool)|([tT]rend)|([cC]omic)|([aA]nima)|([pP]ainti)|\
                  ([fF]iction)|([pP]icture)|(joke)|([hH]oroscope)|([pP]assion)|([sS]tyle)|\
-                 ([cC]ozy)|([bB]log)', x) is not None:
-        return ('Fun')
-    elif x in ['Parkour avoid class', 'community', 'Enthusiasm', 'cosplay', 'IM']:
-        return ('Fun')
-    elif x == 'Personal Effectiveness 1' or x == 'Personal Effectiveness':
-        return ('Productivity')
-    elif re.search(
-            '([iI]ncome)|([pP]rofitabil)|([lL]iquid)|([rR]isk)|([bB]ank)|([fF]uture)|([fF]und)|([sS]tock)|([sS]hare)',
-            x) is not None:
-        return ('Finance')
-    elif re.search('([fF]inanc)|([pP]ay)|(P2P)|([iI]nsura)|([lL]oan)|([cC]ard)|([mM]etal)|\
-                  ([cC]ost)|([wW]ealth)|([bB]roker)|([bB]usiness)|([eE]xchange)', x) is not None:
-        return ('Finance')
-    elif x in ['High Flow', 'Housekeeping', 'Accounting', 'Debit and credit', 'Recipes', 'Heritage Foundation',
-               'IMF', ]:
-        return ('Finance')
-    elif x == 'And the Church':
-        return ('Religion')
-    elif re.search('([sS]ervice)', x) is not None:
-        return ('Services')
-    elif re.search('([aA]viation)|([aA]irlin)|([bB]ooki)|([tT]ravel)|\
-                  ([hH]otel)|([tT]rain)|([tT]axi)|([rR]eservati)|([aA]ir)|([aA]irport)', x) is not None:
-        return ('Travel')
-    elif re.search('([jJ]ourne)|([tT]ransport)|([aA]ccommodat)|([nN]avigat)|([tT]ouris)|([fF]light)|([bB]us)',
-                   x) is not None:
-        return ('Travel')
-    elif x in ['High mobility', 'Destination Region', 'map', 'Weather', 'Rentals']:
-        return ('Travel')
-    elif re.search('([cC]ustom)', x) is not None:
-        return ('Custom')
-    elif x in ['video', 'round', 'the film', 'movie']:
-        return ('Video')
-    elif x in ['Smart Shopping', 'online malls', 'online shopping by group, like groupon', 'takeaway ordering',
-               'online shopping, price comparing', 'Buy class', 'Buy', 'shopping sharing',
-               'Smart Shopping 1', 'online shopping navigation']:
-        return ('Shopping')
-    elif re.search('([eE]ducati)|([rR]ead)|([sS]cienc)|([bB]ooks)', x) is not None:
-        return ('Education')
-    elif x in ['literature', 'Maternal and child population', 'psychology', 'exams', 'millitary and wars', 'news',
-               'foreign language', 'magazine and journal', 'dictionary', 'novels', 'art and culture',
-               'Entertainment News',
-               'College Students', 'math', 'Western Mythology', 'Technology Information', 'study abroad',
-               'Chinese Classical Mythology']:
-        return ('Education')
-    elif x in ['vitality', '1 vitality']:
-        return ('Vitality')
-    elif x in ['sports and gym', 'Health Management', 'Integrated Living', 'Medical', 'Free exercise', 'A beauty care',
-               'fashion', 'fashion outfit', 'lose weight', 'health', 'Skin care applications', 'Wearable Health']:
-        return ('Vitality')
-    elif x in ['sports', 'Sports News']:
-        return ('Sports')
-    elif x == 'music':
-        return ('Music')
-    elif re.search('([hH]otel)', x) is not None:
-        return ('Travel')
-    elif x in ['1 free', 'The elimination of class', 'unknown', 'free', 'comfortable', 'Cozy 1', 'other',
+                 ([cC]ozy)|([bB]log)')),
+    ('Fun', {'Parkour avoid class', 'community', 'Enthusiasm', 'cosplay', 'IM'}),
+    ('Productivity', {'Personal Effectiveness 1', 'Personal Effectiveness'}),
+    ('Finance', re.compile(
+        '([iI]ncome)|([pP]rofitabil)|([lL]iquid)|([rR]isk)|([bB]ank)|([fF]uture)|([fF]und)|([sS]tock)|([sS]hare)')),
+    ('Finance', re.compile('([fF]inanc)|([pP]ay)|(P2P)|([iI]nsura)|([lL]oan)|([cC]ard)|([mM]etal)|\
+                  ([cC]ost)|([wW]ealth)|([bB]roker)|([bB]usiness)|([eE]xchange)')),
+    ('Finance', {'High Flow', 'Housekeeping', 'Accounting', 'Debit and credit', 'Recipes', 'Heritage Foundation',
+                 'IMF'}),
+    ('Religion', {'And the Church'}),
+    ('Services', re.compile('([sS]ervice)')),
+    ('Travel', re.compile('([aA]viation)|([aA]irlin)|([bB]ooki)|([tT]ravel)|\
+                  ([hH]otel)|([tT]rain)|([tT]axi)|([rR]eservati)|([aA]ir)|([aA]irport)')),
+    ('Travel', re.compile(
+        '([jJ]ourne)|([tT]ransport)|([aA]ccommodat)|([nN]avigat)|([tT]ouris)|([fF]light)|([bB]us)')),
+    ('Travel', {'High mobility', 'Destination Region', 'map', 'Weather', 'Rentals'}),
+    ('Custom', re.compile('([cC]ustom)')),
+    ('Video', {'video', 'round', 'the film', 'movie'}),
+    ('Shopping', {'Smart Shopping', 'online malls', 'online shopping by group, like groupon', 'takeaway ordering',
+                  'online shopping, price comparing', 'Buy class', 'Buy', 'shopping sharing',
+                  'Smart Shopping 1', 'online shopping navigation'}),
+    ('Education', re.compile('([eE]ducati)|([rR]ead)|([sS]cienc)|([bB]ooks)')),
+    ('Education', {'literature', 'Maternal and child population', 'psychology', 'exams', 'millitary and wars', 'news',
+                   'foreign language', 'magazine and journal', 'dictionary', 'novels', 'art and culture',
+                   'Entertainment News',
+                   'College Students', 'math', 'Western Mythology', 'Technology Information', 'study abroad',
+                   'Chinese Classical Mythology'}),
+    ('Vitality', {'vitality', '1 vitality'}),
+    ('Vitality', {'sports and gym', 'Health Management', 'Integrated Living', 'Medical', 'Free exercise',
+                  'A beauty care', 'fashion', 'fashion outfit', 'lose weight', 'health', 'Skin care applications',
+                  'Wearable Health'}),
+    ('Sports', {'sports', 'Sports News'}),
+    ('Music', {'music'}),
+    ('Travel', re.compile('([hH]otel)')),
+    ('Other', {'1 free', 'The elimination of class', 'unknown', 'free', 'comfortable', 'Cozy 1', 'other',
                'Total Cost 1', 'Classical 1', 'Quality 1', 'classical', 'quality', 'Car Owners', 'Noble 1',
-               'Pirated content', 'Securities', 'professional skills', 'Jobs', 'Reputation', 'Simple 1', '1 reputation',
-               'Condition of the vehicles', 'magic', 'Internet Securities', 'weibo', 'Housing Advice', 'notes', 'farm',
-               'Nature 1', 'Total Cost', 'Sea Amoy', 'show', 'Car', 'pet raising up', 'dotal-lol', 'Express',
-               'radio', 'Occupational identity', 'Utilities', 'Trust', 'Contacts', 'Simple', 'Automotive News',
-               'Sale of cars', 'File Editor', 'network disk', 'class managemetn', 'management', 'natural',
-               'Points Activities', 'Decoration', 'store management', 'Maternal and child supplies', 'Tour around',
-               'coupon', 'User Community', 'Vermicelli', 'noble', 'poetry', 'Antique collection', 'Reviews',
-               'Scheduling', 'Beauty Nail', 'shows', 'Hardware Related', 'Smart Home', 'Sellers',
-               'Desktop Enhancements',
-               'library', 'entertainment', 'Calendar', 'Ping', 'System Tools', 'KTV', 'Behalf of the drive',
-               'household products', 'Information', 'Man playing favorites', 'App Store', 'Engineering Drawing',
-               'Academic Information', 'Appliances', 'Peace - Search', 'Make-up application', 'WIFI', 'phone',
-               'Doctors',
-               'Smart Appliances', 'reality show', 'Harem', 'trickery', 'Jin Yong', 'effort', 'Xian Xia', 'Romance',
-               'tribe', 'email', 'mesasge', 'Editor', 'Clock', 'search', 'Intelligent hardware', 'Browser',
-               'Furniture']:
-        return ('Other')
-    else:
-        return x
+               'Pirated content', 'Securities', 'professional skills', 'Jobs', 'Reputation', 'Simple 1',
+               '1 reputation', 'Condition of the vehicles', 'magic', 'Internet Securities', 'weibo',
+               'Housing Advice', 'notes', 'farm', 'Nature 1', 'Total Cost', 'Sea Amoy', 'show', 'Car',
+               'pet raising up', 'dotal-lol', 'Express', 'radio', 'Occupational identity', 'Utilities', 'Trust',
+               'Contacts', 'Simple', 'Automotive News', 'Sale of cars', 'File Editor', 'network disk',
+               'class managemetn', 'management', 'natural', 'Points Activities', 'Decoration', 'store management',
+               'Maternal and child supplies', 'Tour around', 'coupon', 'User Community', 'Vermicelli', 'noble',
+               'poetry', 'Antique collection', 'Reviews', 'Scheduling', 'Beauty Nail', 'shows', 'Hardware Related',
+               'Smart Home', 'Sellers', 'Desktop Enhancements', 'library', 'entertainment', 'Calendar', 'Ping',
+               'System Tools', 'KTV', 'Behalf of the drive', 'household products', 'Information',
+               'Man playing favorites', 'App Store', 'Engineering Drawing', 'Academic Information', 'Appliances',
+               'Peace - Search', 'Make-up application', 'WIFI', 'phone', 'Doctors', 'Smart Appliances',
+               'reality show', 'Harem', 'trickery', 'Jin Yong', 'effort', 'Xian Xia', 'Romance', 'tribe', 'email',
+               'mesasge', 'Editor', 'Clock', 'search', 'Intelligent hardware', 'Browser', 'Furniture'}),
+]
+
+
+def change_group_name_2_number(x):
+    return group_numbers.get(x, group_numbers['Other'])
+
+
+def change_category_2_group(x):
+    for group, rule in category_rules:
+        if isinstance(rule, set):
+            if x in rule:
+                return group
+        elif rule.search(x) is not None:
+            return group
+    return x
+
+
+def classify_categories(categories):
+    # group number of each category string, every distinct category is classified once
+    distinct, inverse = np.unique(np.array(categories, dtype=object), return_inverse=True)
+    numbers = np.array(map(lambda x: change_group_name_2_number(change_category_2_group(x)), distinct),
+                       dtype=np.int8)
+    return numbers[inverse]
 
 
 # def stat_app_label():
@@ -316,47 +277,23 @@ def change_category_2_group(x):
 #     print data.shape
 
 
-def encode(d):
-    d[1] = d[1].encode('utf-8')
-    return d
-
-
-def make_brand_model_id():
+def make_brand_model_id(extend=False):
+    vocab_brand = load_vocabulary('brand', 'str', extend)
+    vocab_model = load_vocabulary('model', 'str', extend)
     with open(data_phone_brand_device_model, 'r') as fin:
         next(fin)
 
-        brands = {}
-        models = {}
         for line in fin:
             line = line.decode('utf-8')
             _, b, m = line.strip().split(',')
 
             m = '-'.join([b, m])
 
-            if b not in brands.keys():
-                brands[b] = len(brands)
-
-            if m not in models.keys():
-                models[m] = len(models)
+            vocab_brand.add(b)
+            vocab_model.add(m)
 
-    pkl.dump(brands, open('../data/dict_id_brand.pkl', 'wb'))
-    pkl.dump(models, open('../data/dict_id_model.pkl', 'wb'))
-
-    brands = [[v, k] for k, v in brands.iteritems()]
-    brands = sorted(brands, key=lambda d: d[0])
-    brands = map(encode, brands)
-    with open('../data/id_brand.csv', 'w') as fout:
-        fout.write('brand_id,brand_name\n')
-        for brand_id, brand_name in brands:
-            fout.write('%d,%s\n' % (brand_id, brand_name))
-
-    models = [[v, k] for k, v in models.iteritems()]
-    models = sorted(models, key=lambda d: d[0])
-    models = map(encode, models)
-    with open('../data/id_model.csv', 'w') as fout:
-        fout.write('model_id,model_name,brand_id\n')
-        for model_id, model_name in models:
-            fout.write('%d,%s\n' % (model_id, model_name))
+    dump_vocabulary(vocab_brand, '../data/dict_id_brand.pkl', '../data/id_brand.csv', 'brand_id,brand_name')
+    dump_vocabulary(vocab_model, '../data/dict_id_model.pkl', '../data/id_model.csv', 'model_id,model_name')
 
 
 def aggregate_brand():
@@ -376,11 +313,11 @@ def aggregate_brand():
     pkl.dump(dict, open('../data/dict_brand_model.pkl', 'wb'))
 
 
-def make_device_id():
-    phone = set(np.loadtxt(data_phone_brand_device_model, skiprows=1, delimiter=',', dtype=np.int64, usecols=[0]))
-    event = set(np.loadtxt(data_events, skiprows=1, delimiter=',', dtype=np.int64, usecols=[1]))
-    train = set(np.loadtxt(data_gender_age_train, skiprows=1, delimiter=',', dtype=np.int64, usecols=[0]))
-    test = set(np.loadtxt(data_gender_age_test, skiprows=1, delimiter=',', dtype=np.int64, usecols=[0]))
+def make_device_id(extend=False):
+    phone = set(ingest.unique_column('phone_brand_device_model', 'device_id'))
+    event = set(ingest.unique_column('events', 'device_id'))
+    train = set(ingest.unique_column('gender_age_train', 'device_id'))
+    test = set(ingest.unique_column('gender_age_test', 'device_id'))
 
     print '# device_id: phone', len(phone), 'event', len(event), 'train', len(train), 'test', len(test)
     print 'has device info.', 'train & phone', len(train & phone), 'test & phone', len(test & phone)
@@ -403,28 +340,18 @@ def make_device_id():
 
     print 'phone == (train | test)', phone == (train | test)
 
-    with open('../data/id_device.csv', 'w') as fout:
-        fout.write('did,device_id\n')
-
-        cnt = 0
-        for d in phone:
-            fout.write('%d,%d\n' % (cnt, d))
-            cnt += 1
-
-    data = np.loadtxt('../data/id_device.csv', skiprows=1, delimiter=',', dtype=np.int64)
-    dict = {}
-
-    for k, v in data:
-        dict[v] = k
-
-    pkl.dump(dict, open('../data/dict_id_device.pkl', 'wb'))
+    vocab_device = load_vocabulary('device', extend=extend)
+    for block in ingest.iter_blocks('phone_brand_device_model', ['device_id']):
+        vocab_device.add_all(block['device_id'])
+    dump_vocabulary(vocab_device, '../data/dict_id_device.pkl', '../data/id_device.csv', 'did,device_id')
 
 
 def build_index_brand_model():
-    dict_device = pkl.load(open('../data/dict_id_device.pkl', 'rb'))
+    map_device = vocab.load_id_map('device')
     dict_brand = pkl.load(open('../data/dict_id_brand.pkl', 'rb'))
     dict_model = pkl.load(open('../data/dict_id_model.pkl', 'rb'))
 
+    device_ids = []
     data = []
     with open(data_phone_brand_device_model, 'r') as fin:
         next(fin)
@@ -434,14 +361,17 @@ def build_index_brand_model():
             d, b, m = line.strip().split(',')
             m = '-'.join([b, m])
 
-            d = int(d)
-            did = dict_device[d]
+            device_ids.append(int(d))
             bid = dict_brand[b]
             mid = dict_model[m]
 
-            data.append([did, bid, mid])
+            data.append([-1, bid, mid])
 
     data = np.array(data)
+    dids, missing = map_device.encode_mask(device_ids)
+    if missing.any():
+        raise KeyError(np.asarray(device_ids)[missing][0])
+    data[:, 0] = dids
     print data, data.shape
 
     dict_device_brand_model = {}
@@ -473,171 +403,210 @@ def build_index_brand_model():
 
 
 def make_event_id():
-    event_e = set(np.loadtxt(data_events, skiprows=1, delimiter=',', dtype=np.int64, usecols=[0]))
-    event_a = set(np.loadtxt(data_app_events, skiprows=1, delimiter=',', dtype=np.int64, usecols=[0]))
+    event_e = set(ingest.unique_column('events', 'event_id'))
+    event_a = set(ingest.unique_column('app_events', 'event_id'))
     print '# event in events', len(event_e), '# event in app_events', len(event_a)
     print 'app <= events', event_a <= event_e
 
 
+def get_watermark(table):
+    # the raw csv rows covered by the ingest cache, i.e. by anything built from load_table
+    manifest = ingest.read_manifest(table)
+    return {'source': manifest['source'], 'offset': manifest['source_offset'], 'rows': manifest['rows']}
+
+
+def read_delta(table, watermark):
+    data, offset = ingest.read_tail(table, watermark['offset'])
+    rows = len(data.values()[0])
+    print table, 'new rows', rows, 'after', watermark['rows']
+    return data, {'source': watermark['source'], 'offset': offset, 'rows': watermark['rows'] + rows}
+
+
 def aggregate_device_event():
-    dict_device = pkl.load(open('../data/dict_id_device.pkl', 'rb'))
-    data_e = np.loadtxt(data_events, skiprows=1, delimiter=',',
-                        dtype=[('event_id', np.int64), ('device_id', np.int64), ('timestamp', 'S100'),
-                               ('longitude', np.float64), ('latitude', np.float64)])
-
-    print data_e
-    print data_e.shape
-
-    dict_device_event = {}
-    no_id_device = set()
-    for eid, device_id, timestamp, longitude, latitude in data_e:
-        # print eid, device_id, timestamp, longitude, latitude
-        if device_id not in dict_device:
-            no_id_device.add(device_id)
-            continue
+    map_device = vocab.load_id_map('device')
+    data_e = ingest.load_table('events')
 
-        did = dict_device[device_id]
-        if did in dict_device_event:
-            dict_device_event[did].append((eid, timestamp, longitude, latitude))
-        else:
-            dict_device_event[did] = [(eid, timestamp, longitude, latitude)]
+    dids = map_device.encode(data_e['device_id'])
+    print 'device id not in device_dict', len(np.unique(data_e['device_id'][dids < 0]))
 
-    print 'device id not in device_dict', len(no_id_device)
-    for k in dict_device_event.keys():
-        dict_device_event[k] = sorted(dict_device_event[k], key=lambda d: d[1])
+    device_event_index = event_index.DeviceEventIndex()
+    device_event_index.build(dids, data_e['event_id'], data_e['timestamp'], data_e['longitude'],
+                             data_e['latitude'], map_device.get_size())
+    device_event_index.set_watermark(get_watermark('events'))
+    print 'devices', device_event_index.get_device_size(), 'events', device_event_index.get_event_size()
 
-    print dict_device_event.keys()[:10]
-    print dict_device_event.values()[:10]
+    device_event_index.dump()
 
-    pkl.dump(dict_device_event, open('../data/dict_device_event.pkl', 'wb'))
 
+def append_device_event():
+    map_device = vocab.load_id_map('device')
+    device_event_index = event_index.DeviceEventIndex()
+    device_event_index.load()
+    data_e, watermark = read_delta('events', device_event_index.get_watermark())
+    if watermark['rows'] == device_event_index.get_watermark()['rows']:
+        return
 
-def build_event_dict():
-    dict_device = pkl.load(open('../data/dict_id_device.pkl', 'rb'))
-    data_e = np.loadtxt(data_events, skiprows=1, delimiter=',',
-                        dtype=[('event_id', np.int64), ('device_id', np.int64), ('timestamp', 'S100'),
-                               ('longitude', np.float64), ('latitude', np.float64)])
+    dids = map_device.encode(data_e['device_id'])
+    device_event_index.append(dids, data_e['event_id'], data_e['timestamp'], data_e['longitude'],
+                              data_e['latitude'], map_device.get_size())
+    device_event_index.set_watermark(watermark)
+    print 'devices', device_event_index.get_device_size(), 'events', device_event_index.get_event_size()
 
-    print data_e
-    print data_e.shape
+    device_event_index.dump()
 
-    dict_events = {}
-    for eid, device_id, timestamp, longitude, latitude in data_e:
-        if device_id not in dict_device:
-            print 'not in'
-            continue
 
-        did = dict_device[device_id]
+def update_event_dict(dict_events, map_device, data_e):
+    dids = map_device.encode(data_e['device_id'])
+    print 'device id not in device_dict', np.count_nonzero(dids < 0)
+    has_device = dids >= 0
+    data_e = izip(data_e['event_id'][has_device], dids[has_device], data_e['timestamp'][has_device],
+                  data_e['longitude'][has_device], data_e['latitude'][has_device])
+
+    for eid, did, timestamp, longitude, latitude in data_e:
         dict_events[eid] = (did, timestamp, longitude, latitude)
 
+
+def build_event_dict():
+    map_device = vocab.load_id_map('device')
+    data_e = ingest.load_table('events')
+
+    dict_events = {}
+    update_event_dict(dict_events, map_device, data_e)
+
     print dict_events.keys()[:10]
     print dict_events.values()[:10]
 
     pkl.dump(dict_events, open('../data/dict_event.pkl', 'wb'))
+    event_index.dump_watermark('../data/dict_event_', get_watermark('events'))
 
 
-def aggregate_app_event():
-    dict_app = pkl.load(open('../data/dict_id_app.pkl', 'rb'))
-    data_a = np.loadtxt(data_app_events, skiprows=1, delimiter=',', dtype=np.int64)
+def append_event_dict():
+    map_device = vocab.load_id_map('device')
+    watermark = event_index.load_watermark('../data/dict_event_')
+    data_e, new_watermark = read_delta('events', watermark)
+    if new_watermark['rows'] == watermark['rows']:
+        return
 
-    print data_a
-    print data_a.shape
+    dict_events = pkl.load(open('../data/dict_event.pkl', 'rb'))
+    update_event_dict(dict_events, map_device, data_e)
 
-    dict_app_event = {}
-    for eid, app_id, is_installed, is_active in data_a:
-        aid = dict_app[app_id]
+    pkl.dump(dict_events, open('../data/dict_event.pkl', 'wb'))
+    event_index.dump_watermark('../data/dict_event_', new_watermark)
 
-        if eid in dict_app_event:
-            if is_installed:
-                dict_app_event[eid][0].add(aid)
-            if is_active:
-                dict_app_event[eid][1].add(aid)
-        else:
-            if is_installed:
-                dict_app_event[eid] = ({aid}, set())
-            if is_active:
-                dict_app_event[eid] = (set(), {aid})
-
-    print dict_app_event.keys()[:10]
-    print dict_app_event.values()[:10]
-
-    pkl.dump(dict_app_event, open('../data/dict_app_event.pkl', 'wb'))
-
-
-def count_app_coocur():
-    dict_app = pkl.load(open('../data/dict_id_app.pkl', 'rb'))
-    dict_app_event = pkl.load(open('../data/dict_app_event.pkl', 'rb'))
-    app_coocur = np.zeros([len(dict_app), len(dict_app)], dtype=np.int32)
-    for _, aids in dict_app_event.values():
-        for ai in aids:
-            for aj in aids:
-                if ai != aj:
-                    app_coocur[ai, aj] += 1
-    rows = []
-    cols = []
-    data = []
-    for i in range(len(app_coocur)):
-        for j in range(len(app_coocur[i])):
-            if app_coocur[i, j] > 0:
-                rows.append(i)
-                cols.append(j)
-                data.append(app_coocur[i, j])
-    app_coocur_csr = csr_matrix((data, (rows, cols)))
-    pkl.dump(app_coocur_csr, open('../data/app_coocur.pkl', 'wb'))
-    app_coocur_tfidf = tf_idf(app_coocur)
-    pkl.dump(app_coocur_tfidf, open('../data/app_coocur_tfidf.pkl', 'wb'))
-
-
-def count_label_coocur():
-    dict_label = pkl.load(open('../data/dict_id_label.pkl', 'rb'))
-    dict_app_event = pkl.load(open('../data/dict_app_event.pkl', 'rb'))
-    dict_app_label = pkl.load(open('../data/dict_app_label.pkl', 'rb'))
-    label_coocur = np.zeros([len(dict_label), len(dict_label)], dtype=np.int32)
-    print len(dict_app_event)
-    cnt = 0
-    start_time = time.time()
-    for _, aids in dict_app_event.values():
-        cnt += 1
-        if cnt % 10000 == 0:
-            print cnt, time.time() - start_time
-            start_time = time.time()
-        tmp = set()
-        for ai in aids:
-            tmp |= dict_app_label[ai]
-        for li in tmp:
-            for lj in tmp:
-                if li != lj:
-                    label_coocur[li, lj] += 1
-    rows = []
-    cols = []
-    data = []
-    for i in range(len(label_coocur)):
-        for j in range(len(label_coocur[i])):
-            if label_coocur[i, j] > 0:
-                rows.append(i)
-                cols.append(j)
-                data.append(label_coocur[i, j])
-    label_coocur_csr = csr_matrix((data, (rows, cols)))
-    pkl.dump(label_coocur_csr, open('../data/label_coocur.pkl', 'wb'))
-    label_coocur_tfidf = tf_idf(label_coocur_csr)
-    pkl.dump(label_coocur_tfidf, open('../data/label_coocur_tfidf.pkl', 'wb'))
 
+def aggregate_app_event():
+    map_app = vocab.load_id_map('app')
+    data_a = ingest.load_table('app_events')
+
+    aids = map_app.encode(data_a['app_id'])
+
+    app_event_index = event_index.AppEventIndex()
+    app_event_index.build(data_a['event_id'], aids, data_a['is_installed'], data_a['is_active'],
+                          map_app.get_size())
+    app_event_index.set_watermark(get_watermark('app_events'))
+    print 'events', app_event_index.get_event_size(), 'installed', app_event_index.get_installed().nnz, \
+        'active', app_event_index.get_active().nnz
+
+    app_event_index.dump()
+
+
+def append_app_event():
+    app_event_index = event_index.AppEventIndex()
+    app_event_index.load()
+    data_a, watermark = read_delta('app_events', app_event_index.get_watermark())
+    if watermark['rows'] == app_event_index.get_watermark()['rows']:
+        return
+
+    # apps first seen in the delta get new ids, the old ones never move
+    vocab_app = load_vocabulary('app', extend=True)
+    num_app = vocab_app.get_size()
+    vocab_app.add_all(data_a['app_id'])
+    if vocab_app.get_size() > num_app:
+        dump_vocabulary(vocab_app, '../data/dict_id_app.pkl', '../data/id_app.csv', 'aid,app_id')
+    aids = vocab_app.encode(data_a['app_id'])
+
+    app_event_index.append(data_a['event_id'], aids, data_a['is_installed'], data_a['is_active'],
+                           vocab_app.get_size())
+    app_event_index.set_watermark(watermark)
+    print 'events', app_event_index.get_event_size(), 'installed', app_event_index.get_installed().nnz, \
+        'active', app_event_index.get_active().nnz
+
+    app_event_index.dump()
+
+
+def append_events():
+    # idempotent, each index only takes the rows past its own watermark
+    append_device_event()
+    append_event_dict()
+    append_app_event()
+
+
+coocur_incidence = None
+
+
+def count_coocur_chunk(chunk):
+    begin, end = chunk
+    x = coocur_incidence[begin:end]
+    return x.transpose().tocsr().dot(x)
+
+
+def count_coocur(incidence, num_worker=None, chunk_size=200000):
+    # sparse X^T X of a binary (event x item) incidence, events are split into chunks over a process pool,
+    # workers see the incidence through fork
+    global coocur_incidence
+    coocur_incidence = incidence
+    chunks = [(b, min(b + chunk_size, incidence.shape[0])) for b in range(0, incidence.shape[0], chunk_size)]
+    pool = Pool(num_worker)
+    try:
+        parts = pool.map(count_coocur_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+        coocur_incidence = None
+    coocur = csr_matrix((incidence.shape[1], incidence.shape[1]), dtype=incidence.dtype)
+    for p in parts:
+        coocur = coocur + p
+    coocur = coocur.tocoo()
+    off_diag = coocur.row != coocur.col
+    return csr_matrix((coocur.data[off_diag], (coocur.row[off_diag], coocur.col[off_diag])), shape=coocur.shape)
+
+
+def count_app_coocur(num_worker=None):
+    app_event_index = event_index.AppEventIndex()
+    app_event_index.load()
+    start_time = time.time()
+    app_coocur_csr = count_coocur(app_event_index.get_active(), num_worker)
+    print 'app coocur', app_coocur_csr.shape, app_coocur_csr.nnz, 'finish in %d sec' % (time.time() - start_time)
+    pkl.dump(app_coocur_csr, open('../data/app_coocur.pkl', 'wb'), pkl.HIGHEST_PROTOCOL)
+    app_coocur_tfidf = tf_idf(app_coocur_csr)
+    pkl.dump(app_coocur_tfidf, open('../data/app_coocur_tfidf.pkl', 'wb'), pkl.HIGHEST_PROTOCOL)
 
-class edge:
-    def __init__(self, cost, node1, node2):
-        self.cost = cost
-        self.node1 = node1
-        self.node2 = node2
 
-    def __cmp__(self, other):
-        return self.cost < other.cost
+def count_label_coocur(num_worker=None):
+    map_label = vocab.load_id_map('label')
+    dict_app_label = pkl.load(open('../data/dict_app_label.pkl', 'rb'))
+    app_event_index = event_index.AppEventIndex()
+    app_event_index.load()
+    start_time = time.time()
+    app_label = utils.dict_2_csr(dict_app_label, [app_event_index.get_app_size(), map_label.get_size()])
+    # labels owned by the active apps of each event, as a set
+    event_label = app_event_index.get_active().dot(app_label)
+    event_label.data[:] = 1
+    label_coocur_csr = count_coocur(event_label, num_worker)
+    print 'label coocur', label_coocur_csr.shape, label_coocur_csr.nnz, 'finish in %d sec' % (
+        time.time() - start_time)
+    pkl.dump(label_coocur_csr, open('../data/label_coocur.pkl', 'wb'), pkl.HIGHEST_PROTOCOL)
+    label_coocur_tfidf = tf_idf(label_coocur_csr)
+    pkl.dump(label_coocur_tfidf, open('../data/label_coocur_tfidf.pkl', 'wb'), pkl.HIGHEST_PROTOCOL)
 
 
 def find_parent(parent, i):
-    if parent[i] == i:
-        return i
-    parent[i] = find_parent(parent, parent[i])
-    return parent[i]
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
 
 
 def join_parent(parent, i, j):
@@ -645,100 +614,179 @@ def join_parent(parent, i, j):
     parent[j_parent] = find_parent(parent, i)
 
 
-def coocur_cluster(path, threshold=0.0):
-    coocur_tfidf = pkl.load(open(path, 'rb'))
-    coocur_tfidf += coocur_tfidf.transpose()
-    coocur_tfidf /= 2
-    csr_indices = coocur_tfidf.indices
-    csr_indptr = coocur_tfidf.indptr
-    csr_data = coocur_tfidf.data
-    q = PriorityQueue()
-    print 'make heap...'
-    parent = np.arange((coocur_tfidf.shape[0]))
-    for i in range(coocur_tfidf.shape[0]):
-        for ij in range(csr_indptr[i], csr_indptr[i + 1]):
-            j = csr_indices[ij]
-            d = csr_data[ij]
-            if i < j and d > threshold:
-                q.put(edge(d, i, j))
-    print 'find and join...'
-    while not q.empty():
-        next_edge = q.get()
-        node1 = next_edge.node1
-        node2 = next_edge.node2
+def single_linkage(sim):
+    # kruskal on a symmetric similarity matrix, strongest edges first.
+    # returns the merge tree: merged node pairs and the similarity each merge happened at
+    edges = triu(sim, k=1).tocoo()
+    order = np.argsort(-edges.data, kind='mergesort')
+    parent = np.arange(sim.shape[0])
+    merge_pairs = []
+    merge_costs = []
+    for e in order:
+        node1 = edges.row[e]
+        node2 = edges.col[e]
         n1_parent = find_parent(parent, node1)
         n2_parent = find_parent(parent, node2)
         if n1_parent == n2_parent:
             continue
-        elif n2_parent == node2:
-            join_parent(parent, node1, node2)
-        elif n1_parent == node1:
-            join_parent(parent, node2, node1)
-        else:
-            join_parent(parent, node1, node2)
-    clusters = []
-    for i in range(coocur_tfidf.shape[0]):
-        son_i = np.where(parent == i)[0]
-        if len(son_i) > 0:
-            clusters.append(son_i)
-    clusters = np.array(clusters)
-    print len(clusters)
-    print clusters
-    dict_label_cluster = {}
-    cnt = 0
-    for c in clusters:
-        for l in c:
-            dict_label_cluster[l] = cnt
-        cnt += 1
-    pkl.dump(dict_label_cluster, open('../data/dict_label_cluster_500.pkl', 'wb'))
+        parent[n2_parent] = n1_parent
+        merge_pairs.append((node1, node2))
+        merge_costs.append(edges.data[e])
+    return np.array(merge_pairs, dtype=np.int64).reshape([-1, 2]), np.array(merge_costs, dtype=np.float64)
+
+
+def cut_merge_tree(num_node, merge_pairs, num_merge):
+    # cluster id of each node after replaying the first num_merge merges
+    parent = np.arange(num_node)
+    for node1, node2 in merge_pairs[:num_merge]:
+        join_parent(parent, node1, node2)
+    roots = np.array([find_parent(parent, i) for i in range(num_node)])
+    _, clusters = np.unique(roots, return_inverse=True)
+    return clusters
+
+
+def coocur_cluster(path, num_clusters=(), thresholds=()):
+    coocur_tfidf = pkl.load(open(path, 'rb'))
+    coocur_tfidf = (coocur_tfidf + coocur_tfidf.transpose()) / 2
+    num_node = coocur_tfidf.shape[0]
+    print 'build merge tree...'
+    merge_pairs, merge_costs = single_linkage(coocur_tfidf)
+    print 'merges', len(merge_pairs), 'min clusters', num_node - len(merge_pairs)
+
+    # (file suffix, merges to replay), requested cluster numbers name their file even when the tree
+    # cannot reach them exactly, k beyond the node number keeps every node apart
+    cuts = [(k, max(0, min(num_node - k, len(merge_pairs)))) for k in num_clusters]
+    # merge costs are non-increasing, a threshold keeps every merge above it
+    cuts += [(None, int(np.count_nonzero(merge_costs > t))) for t in thresholds]
+    for k, num_merge in cuts:
+        clusters = cut_merge_tree(num_node, merge_pairs, num_merge)
+        num_cluster = clusters.max() + 1
+        print 'clusters', num_cluster, 'requested', k
+        dict_label_cluster = dict(enumerate(clusters.tolist()))
+        if k is None:
+            k = num_cluster
+        pkl.dump(dict_label_cluster, open('../data/dict_label_cluster_%d.pkl' % k, 'wb'))
 
 
 def aggregate_model_cluster(name):
     fea_tmp = feature.MultiFeature(name=name, dtype='f')
     fea_tmp.load()
     indices, values = fea_tmp.get_value()
-    models = np.reshape(indices[:, 0], [-1])
+    models = np.reshape(indices[:, 0], [-1]).astype(np.int64)
     preds = values[:, 1:]
-    model_centers = {}
-    for mid in models:
-        if mid not in model_centers:
-            model_ind = np.where(models == mid)[0]
-            model_centers[mid] = np.mean(preds[model_ind], axis=0)
-    pkl.dump(model_centers, open('../data/' + name + '.pkl', 'wb'))
-
-
-def app_label_matrix(max_iter, rank):
-    dict_id_app = pkl.load(open('../data/dict_id_app.pkl'))
-    dict_id_label = pkl.load(open('../data/dict_id_label.pkl'))
-    dict_app_label = pkl.load(open('../data/dict_app_label.pkl'))
-    rows = []
-    cols = []
-    for i in range(len(dict_id_app)):
-        lids = dict_app_label[i]
-        for lid in lids:
-            rows.append(i)
-            cols.append(lid)
-    rows = np.array(rows)
-    cols = np.array(cols)
-    data = np.ones_like(rows, dtype=np.int32)
-    V = coo_matrix((data, (rows, cols)), shape=[len(dict_id_app), len(dict_id_label)])
-    nmf = nimfa.Nmf(V, max_iter=max_iter, rank=rank, update='euclidean', objective='fro')
+
+    dict_device_brand_model = pkl.load(open('../data/dict_device_brand_model.pkl', 'rb'))
+    model_brand = {}
+    for bid, mid in dict_device_brand_model.itervalues():
+        model_brand[mid] = bid
+    unique_models, inverse = np.unique(models, return_inverse=True)
+    brands = np.array([model_brand.get(mid, -1) for mid in unique_models], dtype=np.int64)[inverse]
+
+    groupings = [('', models), ('_brand', brands), ('_brand_model', [brands, models])]
+    for suffix, keys in groupings:
+        groups, centers, counts = utils.group_mean(keys, preds)
+        if groups.ndim > 1:
+            groups = map(tuple, groups)
+        print name + suffix, 'groups', len(counts)
+        pkl.dump(dict(zip(groups, centers)), open('../data/' + name + suffix + '.pkl', 'wb'))
+
+
+app_label_v = None
+
+
+def load_app_label_matrix():
+    map_app = vocab.load_id_map('app')
+    map_label = vocab.load_id_map('label')
+    dict_app_label = pkl.load(open('../data/dict_app_label.pkl', 'rb'))
+    return utils.dict_2_csr(dict_app_label, [map_app.get_size(), map_label.get_size()], np.float64)
+
+
+def get_nmf_path(rank):
+    return '../data/app_label_nmf_%d' % rank
+
+
+def dump_nmf(rank, W, H):
+    np.save(get_nmf_path(rank) + '_W.npy', W)
+    np.save(get_nmf_path(rank) + '_H.npy', H)
+
+
+def load_nmf(rank):
+    return np.load(get_nmf_path(rank) + '_W.npy'), np.load(get_nmf_path(rank) + '_H.npy')
+
+
+def factors_fit(W, H, shape):
+    # factors left by a run over another vocabulary cannot seed this matrix
+    return W.shape[0] == shape[0] and H.shape[1] == shape[1] and W.shape[1] == H.shape[0]
+
+
+def find_warm_rank(rank, shape):
+    # largest smaller rank already factorized for a matrix of this shape, its factors seed this one
+    warm_rank = None
+    for r in range(1, rank):
+        if os.path.exists(get_nmf_path(r) + '_W.npy') and os.path.exists(get_nmf_path(r) + '_H.npy'):
+            W = np.load(get_nmf_path(r) + '_W.npy', mmap_mode='r')
+            H = np.load(get_nmf_path(r) + '_H.npy', mmap_mode='r')
+            if factors_fit(W, H, shape):
+                warm_rank = r
+    return warm_rank
+
+
+def pad_factors(W, H, rank):
+    # new components start as small noise next to the ones already found
+    W_pad = np.random.rand(W.shape[0], rank) * W.mean() * 0.1
+    H_pad = np.random.rand(rank, H.shape[1]) * H.mean() * 0.1
+    W_pad[:, :W.shape[1]] = W
+    H_pad[:H.shape[0], :] = H
+    return W_pad, H_pad
+
+
+def app_label_nmf(task):
+    rank, max_iter, warm_rank = task
+    start_time = time.time()
+    V = app_label_v
+    if warm_rank is not None and not factors_fit(*(load_nmf(warm_rank) + (V.shape,))):
+        print 'rank', warm_rank, 'factors do not fit', V.shape, 'cold start'
+        warm_rank = None
+    if warm_rank is None:
+        nmf = nimfa.Nmf(V, max_iter=max_iter, rank=rank, update='euclidean', objective='fro')
+    else:
+        W, H = pad_factors(*(load_nmf(warm_rank) + (rank,)))
+        nmf = nimfa.Nmf(V, seed=None, W=W, H=H, max_iter=max_iter, rank=rank, update='euclidean', objective='fro')
     nmf_fit = nmf()
 
     W = nmf_fit.basis()
-    print('Basis matrix:\n%s' % W.todense())
-
     H = nmf_fit.coef()
-    print('Mixture matrix:\n%s' % H.todense())
+    if issparse(W):
+        W = W.toarray()
+    if issparse(H):
+        H = H.toarray()
+    dump_nmf(rank, np.asarray(W), np.asarray(H))
 
-    pkl.dump({'W': W.todense(), 'H': H.todense()}, open('../data/app_label_nmf_%d.pkl' % rank, 'wb'))
+    sm = nmf_fit.summary()
+    return rank, warm_rank, nmf_fit.distance(metric='euclidean'), sm['n_iter'], time.time() - start_time
 
-    print('Euclidean distance: %5.3f' % nmf_fit.distance(metric='euclidean'))
 
-    sm = nmf_fit.summary()
-    print('Sparseness Basis: %5.3f  Mixture: %5.3f' % (sm['sparseness'][0], sm['sparseness'][1]))
-    print('Iterations: %d' % sm['n_iter'])
-    print('Target estimate:\n%s' % np.dot(W.todense(), H.todense()))
+def app_label_matrix(max_iter, ranks, num_worker=None, warm_start=True):
+    # ranks are factorized concurrently, each warm-starts from factors a previous sweep left for a smaller rank
+    global app_label_v
+    app_label_v = load_app_label_matrix()
+    print 'app label', app_label_v.shape, app_label_v.nnz
+
+    tasks = []
+    # largest ranks are the slowest, they go first
+    for rank in sorted(ranks, reverse=True):
+        warm_rank = find_warm_rank(rank, app_label_v.shape) if warm_start else None
+        tasks.append((rank, max_iter, warm_rank))
+
+    pool = Pool(num_worker)
+    results = pool.map(app_label_nmf, tasks, 1)
+    pool.close()
+    pool.join()
+    app_label_v = None
+
+    for rank, warm_rank, distance, n_iter, elapsed in sorted(results):
+        print 'rank', rank, 'warm start', warm_rank, 'Euclidean distance: %5.3f' % distance, 'iterations', n_iter, \
+            'finish in %d sec' % elapsed
 
 
 if __name__ == '__main__':
@@ -747,8 +795,6 @@ if __name__ == '__main__':
     # count_app_coocur()
     # count_label_coocur()
     # path = '../data/label_coocur_tfidf.pkl'
-    # for t in [0.032]:
-    #     coocur_cluster(path, t)
+    # coocur_cluster(path, num_clusters=[40, 100, 270, 500])
     # aggregate_model_cluster('model_cluster_1')
-    for rank in [2, 4]:
-        app_label_matrix(200, rank)
+    app_label_matrix(200, [2, 4])
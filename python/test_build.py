@@ -0,0 +1,85 @@
+import inspect
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import build
+
+local_modules = ['event_index', 'feature', 'feature_factory', 'feature_impl', 'ingest', 'normalizer', 'stat', 'tf_idf',
+                 'utils', 'vocab']
+# decide whether a feature is recomputed, not what it holds
+cache_code = set([('feature_cache', 'FeatureCache'), ('feature_factory', 'get_feature_inputs')])
+
+
+def called_code(module, func):
+    # functions a stage function reaches by name in its own module, and the functions and classes of other
+    # local modules they name
+    mod = build.load_module(module)
+    code = set()
+    queue = [func]
+    seen = set()
+    while len(queue) > 0:
+        name = queue.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        cos = [getattr(mod, name).func_code]
+        while len(cos) > 0:
+            co = cos.pop()
+            cos.extend([c for c in co.co_consts if inspect.iscode(c)])
+            for attr in co.co_names:
+                value = getattr(mod, attr, None)
+                if inspect.isfunction(value) and value.__module__ == mod.__name__:
+                    code.add((module, attr))
+                    queue.append(attr)
+                elif inspect.ismodule(value) and value.__name__ in local_modules:
+                    for other in co.co_names:
+                        if inspect.isfunction(getattr(value, other, None)) or \
+                                inspect.isclass(getattr(value, other, None)):
+                            code.add((value.__name__, other))
+    return code
+
+
+class BuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path_state = os.path.join(self.tmp_dir, 'build_state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pooled_stage_with_workers(self):
+        # count_coocur starts a pool of its own, stage processes must be allowed to have children
+        incidence = csr_matrix((np.random.rand(50, 8) > 0.5).astype(np.int32))
+        builder = build.Builder(num_worker=2, path=self.path_state)
+        builder.add_stage(build.Stage('coocur_a', 'stat', 'count_coocur', [incidence, 2, 10]))
+        builder.add_stage(build.Stage('coocur_b', 'stat', 'count_coocur', [incidence, 2, 20]))
+        builder.build()
+        builder.load_state()
+        self.assertTrue(builder.is_fresh('coocur_a', build.stage_fingerprint(builder.get_stage('coocur_a'))))
+        self.assertTrue(builder.is_fresh('coocur_b', build.stage_fingerprint(builder.get_stage('coocur_b'))))
+
+    def test_failed_stage(self):
+        builder = build.Builder(num_worker=2, path=self.path_state)
+        builder.add_stage(build.Stage('coocur', 'stat', 'count_coocur', [None, 2]))
+        self.assertRaises(RuntimeError, builder.build)
+
+    def test_stage_code_covers_calls(self):
+        for fused in [False, True]:
+            builder = build.default_builder(fused=fused)
+            for name in builder.get_stage_names():
+                stage = builder.get_stage(name)
+                code = set(stage.get_code())
+                # a listed method stands for its class
+                code |= set([(module, func.split('.')[0]) for module, func in code])
+                self.assertTrue((stage.get_module(), stage.get_func()) in code, name)
+                self.assertEqual(set(), called_code(stage.get_module(), stage.get_func()) - code - cache_code, name)
+                build.stage_fingerprint(stage)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import inspect
+import unittest
+
+import numpy as np
+
+import event_index
+import feature
+import feature_impl
+import normalizer
+import utils
+
+
+def make_data(num_device=60, num_event=600, num_app=30, num_label=20, seed=0):
+    rng = np.random.RandomState(seed)
+    # a few heavy devices and some without events, so shards are uneven
+    did = np.concatenate([rng.randint(0, num_device - 5, num_event - 100), np.repeat([1, 2], 50)])
+    event_id = np.arange(num_event)
+    epoch = 1462060800 + rng.randint(0, 7 * 86400, num_event)
+    timestamp = map(event_index.epoch_2_timestamp, epoch)
+    longitude = np.where(rng.rand(num_event) < 0.2, 0, rng.uniform(100, 120, num_event))
+    latitude = np.where(longitude == 0, 0, rng.uniform(20, 40, num_event))
+    device_index = event_index.DeviceEventIndex()
+    device_index.build(did, event_id, timestamp, longitude, latitude, num_device)
+
+    app_event = rng.randint(0, num_event, 2000)
+    app_index = event_index.AppEventIndex()
+    app_index.build(app_event, rng.randint(0, num_app, 2000), np.ones(2000), rng.rand(2000) < 0.4, num_app)
+
+    dict_app_label = {}
+    for aid in range(num_app + 5):
+        dict_app_label[aid] = set(rng.randint(0, num_label, rng.randint(1, 4)))
+    data = {
+        'device_id': np.arange(num_device),
+        'dict_device_event': event_index.DeviceEventDict(device_index),
+        'dict_app_event': event_index.AppEventDict(app_index),
+        'dict_app_label': dict_app_label,
+        'dict_device_brand_model': dict([(d, (d % 7, d % 11)) for d in range(num_device)]),
+    }
+    for name, num_group in [('dict_label_category_group', 19), ('dict_label_cluster_40', 40),
+                            ('dict_label_cluster_100', 100), ('dict_label_cluster_270', 270)]:
+        data[name] = dict([(l, rng.randint(0, num_group)) for l in range(num_label)])
+    return data
+
+
+def called_code(func):
+    # (module, function) pairs of feature_impl that func reaches by name, through the functions it calls
+    modules = dict([(m.__name__, m) for m in [event_index, feature_impl, normalizer, utils]])
+    code = set()
+    queue = [func.func_code]
+    while len(queue) > 0:
+        co = queue.pop()
+        queue.extend([c for c in co.co_consts if inspect.iscode(c)])
+        for name in co.co_names:
+            value = getattr(feature_impl, name, None)
+            if inspect.isfunction(value) and value.__module__ == 'feature_impl' and \
+                    ('feature_impl', name) not in code:
+                code.add(('feature_impl', name))
+                queue.append(value.func_code)
+            elif inspect.ismodule(value) and value.__name__ in modules and value is not feature_impl:
+                for attr in co.co_names:
+                    if inspect.isfunction(getattr(value, attr, None)) or inspect.isclass(getattr(value, attr, None)):
+                        code.add((value.__name__, attr))
+    return code
+
+
+def rows_2_list(rows):
+    return map(lambda x: np.atleast_1d(x).tolist(), rows)
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.data = make_data()
+
+    def test_sharded_equals_unsharded(self):
+        for name in sorted(feature_impl.row_local_procs):
+            proc = getattr(feature_impl, name + '_proc')
+            argv = dict([(a, self.data[a]) for a in inspect.getargspec(proc).args])
+            indices, values = proc(**argv)
+            sharded_indices, sharded_values = feature.process_sharded(proc, argv, 3)
+            self.assertEqual(rows_2_list(indices), rows_2_list(sharded_indices), name)
+            self.assertEqual(rows_2_list(values), rows_2_list(sharded_values), name)
+
+    def test_global_proc_not_sharded(self):
+        self.assertFalse(feature.MultiFeature(name='device_long_lat_norm').is_shardable())
+        self.assertTrue(feature.MultiFeature(name='device_long_lat').is_shardable())
+
+
+class ProcCodeTest(unittest.TestCase):
+    def test_proc_code_covers_calls(self):
+        for name in dir(feature_impl):
+            if not name.endswith('_proc'):
+                continue
+            code = feature_impl.get_proc_code(name[:-len('_proc')])
+            self.assertEqual(set(), called_code(getattr(feature_impl, name)) - set(code), name)
+            for module, func in code:
+                self.assertTrue(inspect.getsource(reduce(getattr, func.split('.'), globals()[module])), func)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ import cPickle as pkl
 
 import numpy as np
 import tensorflow as tf
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 
 import feature
 
@@ -191,6 +191,31 @@ def libsvm_2_csr(indices, values, space):
     return coo_mat.tocsr()
 
 
+def dict_2_csr(dict_sets, shape, dtype=np.int32):
+    # {row: set of cols} -> binary csr
+    rows = []
+    cols = []
+    for k, v in dict_sets.iteritems():
+        rows.extend([k] * len(v))
+        cols.extend(v)
+    data = np.ones(len(rows), dtype=dtype)
+    coo_mat = coo_matrix((data, (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))), shape=shape)
+    return coo_mat.tocsr()
+
+
+def group_mean(keys, values):
+    # mean of the rows of values (dense or sparse) grouped by keys, a list of key arrays groups by their combination
+    if isinstance(keys, (list, tuple)):
+        groups, inverse = np.unique(np.column_stack(keys), axis=0, return_inverse=True)
+    else:
+        groups, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+    # row i of the indicator averages the rows of group i, so one product gives every centroid
+    indicator = csr_matrix((1.0 / counts[inverse], (inverse, np.arange(len(inverse)))),
+                           shape=(len(groups), len(inverse)))
+    return groups, indicator.dot(values), counts
+
+
 def libsvm_2_feature(indices, values, spaces, types):
     if check_type(spaces, 'int'):
         if types == 'sparse':
@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+
+path_vocab = '../data/vocab/'
+
+
+class IdMap:
+    # int64 key -> int64 value as two arrays sorted by key, looked up with searchsorted
+    def __init__(self, name, path=path_vocab):
+        self.__name = name
+        self.__path = path
+        self.__keys = None
+        self.__values = None
+        self.__inverse = None
+
+    def get_name(self):
+        return self.__name
+
+    def get_keys(self):
+        return self.__keys
+
+    def get_values(self):
+        return self.__values
+
+    def get_size(self):
+        return len(self.__keys)
+
+    def set_value(self, keys, values):
+        self.__keys = keys
+        self.__values = values
+        self.__inverse = None
+
+    def build(self, keys, values):
+        keys = np.asarray(keys, dtype=np.int64)
+        order = np.argsort(keys, kind='mergesort')
+        self.set_value(keys[order], np.asarray(values, dtype=np.int64)[order])
+
+    def lookup(self, keys):
+        # positions of keys in the sorted key array, and which of them exist
+        keys = np.asarray(keys, dtype=np.int64)
+        pos = np.searchsorted(self.__keys, keys)
+        pos[pos == len(self.__keys)] = 0
+        if len(self.__keys) == 0:
+            return pos, np.zeros(len(keys), dtype=bool)
+        return pos, self.__keys[pos] == keys
+
+    def encode(self, keys, default=-1):
+        pos, found = self.lookup(keys)
+        if len(self.__keys) == 0:
+            return np.zeros(len(pos), dtype=np.int64) + default
+        return np.where(found, self.__values[pos], default)
+
+    def encode_mask(self, keys):
+        # values with a mask of the keys that are missing, their values are undefined
+        pos, found = self.lookup(keys)
+        if len(self.__keys) == 0:
+            return pos, ~found
+        return np.asarray(self.__values[pos]), ~found
+
+    def decode(self, values, default=-1):
+        if self.__inverse is None:
+            inverse = np.argsort(self.__values, kind='mergesort')
+            self.__inverse = (np.asarray(self.__values[inverse]), np.asarray(self.__keys[inverse]))
+        sorted_values, keys = self.__inverse
+        values = np.asarray(values, dtype=np.int64)
+        pos = np.searchsorted(sorted_values, values)
+        pos[pos == len(sorted_values)] = 0
+        if len(sorted_values) == 0:
+            return np.zeros(len(values), dtype=np.int64) + default
+        return np.where(sorted_values[pos] == values, keys[pos], default)
+
+    def __contains__(self, key):
+        return bool(self.lookup([key])[1][0])
+
+    def __getitem__(self, key):
+        pos, found = self.lookup([key])
+        if not found[0]:
+            raise KeyError(key)
+        return self.__values[pos[0]]
+
+    def __len__(self):
+        return self.get_size()
+
+    def get_files(self):
+        return [self.__path + self.__name + '_keys.npy', self.__path + self.__name + '_values.npy']
+
+    def dump(self):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        np.save(self.__path + self.__name + '_keys.npy', self.__keys)
+        np.save(self.__path + self.__name + '_values.npy', self.__values)
+
+    def exists(self):
+        return os.path.exists(self.__path + self.__name + '_values.npy')
+
+    def load(self, mmap_mode='r'):
+        keys = np.load(self.__path + self.__name + '_keys.npy', mmap_mode=mmap_mode)
+        values = np.load(self.__path + self.__name + '_values.npy', mmap_mode=mmap_mode)
+        self.set_value(keys, values)
+
+
+def load_id_map(name, path=path_vocab):
+    id_map = IdMap(name, path)
+    id_map.load()
+    return id_map
+
+
+class Vocabulary:
+    # interns values to dense ids in order of first appearance, ids never change once assigned
+    def __init__(self, name, dtype='int', path=path_vocab):
+        self.__name = name
+        self.__dtype = dtype
+        self.__path = path
+        self.__index = {}
+        self.__values = []
+
+    def get_name(self):
+        return self.__name
+
+    def get_data_type(self):
+        return self.__dtype
+
+    def get_size(self):
+        return len(self.__values)
+
+    def get_values(self):
+        return self.__values
+
+    def get_id(self, value, default=None):
+        return self.__index.get(value, default)
+
+    def get_value(self, vid):
+        return self.__values[vid]
+
+    def add(self, value):
+        vid = self.__index.get(value)
+        if vid is None:
+            vid = len(self.__values)
+            self.__index[value] = vid
+            self.__values.append(value)
+        return vid
+
+    def add_all(self, values):
+        if isinstance(values, np.ndarray):
+            # only the distinct values go through the hash, in order of first appearance
+            distinct, first = np.unique(values, return_index=True)
+            values = distinct[np.argsort(first, kind='mergesort')].tolist()
+        for v in values:
+            self.add(v)
+
+    def encode(self, values, default=-1):
+        if self.__dtype == 'int':
+            return self.to_id_map().encode(values, default)
+        return np.array([self.__index.get(v, default) for v in values], dtype=np.int64)
+
+    def decode(self, ids):
+        return [self.__values[i] for i in ids]
+
+    def to_dict(self):
+        return dict(self.__index)
+
+    def to_id_map(self):
+        id_map = IdMap(self.__name, self.__path)
+        id_map.build(self.__values, np.arange(len(self.__values)))
+        return id_map
+
+    def dump(self):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        print 'vocabulary dumped at: %s' % (self.__path + self.__name), 'size', self.get_size()
+        if self.__dtype == 'int':
+            np.save(self.__path + self.__name + '.npy', np.array(self.__values, dtype=np.int64))
+            self.to_id_map().dump()
+        else:
+            # utf-8 blob + offsets
+            encoded = [v.encode('utf-8') for v in self.__values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(map(len, encoded))
+            np.save(self.__path + self.__name + '.npy', offsets)
+            with open(self.__path + self.__name + '.bin', 'wb') as fout:
+                fout.write(''.join(encoded))
+
+    def exists(self):
+        return os.path.exists(self.__path + self.__name + '.npy')
+
+    def load(self):
+        if self.__dtype == 'int':
+            values = np.load(self.__path + self.__name + '.npy').tolist()
+        else:
+            offsets = np.load(self.__path + self.__name + '.npy')
+            with open(self.__path + self.__name + '.bin', 'rb') as fin:
+                blob = fin.read()
+            values = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+        self.__values = values
+        self.__index = dict(zip(values, range(len(values))))